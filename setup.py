@@ -39,6 +39,7 @@ setup(
     ],
     extras_require={
         "rocrate": ["rocrate>=0.7.0, <1.0.0"],
+        "zstd": ["zstandard>=0.18.0"],
     },
     python_requires='>=3.8',
 
@@ -0,0 +1,623 @@
+# Copyright (C) 2022 The Jackson Laboratory
+# All rights reserved.
+#
+# Use is subject to license terms supplied in LICENSE.
+
+from pathlib import Path, PurePosixPath
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
+from zipfile import structFileHeader, sizeFileHeader, stringFileHeader
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+import gzip
+import hashlib
+import io
+import os
+import queue
+import shutil
+import struct
+import tarfile
+import threading
+import time
+import zlib
+
+# members up to this size are read before taking the archive lock, so
+# several workers can download small files at the same time
+MEMBER_BUFFER_SIZE = 8 * 1024 * 1024
+# members of at least this size are sampled, and stored rather than
+# compressed if the sample does not shrink below INCOMPRESSIBLE_RATIO
+SAMPLE_MIN_SIZE = 1024 * 1024
+SAMPLE_SIZE = 256 * 1024
+INCOMPRESSIBLE_RATIO = 0.95
+COMPRESS_CHUNK_SIZE = 4 * 1024 * 1024
+COMPRESS_FORMATS = ["tar.gz", "tar.zst"]
+# zstd has no stored mode; its fastest levels emit raw blocks for
+# incompressible data at little cost
+ZSTD_STORE_LEVEL = -5
+
+
+def import_zstandard():
+    import importlib.util
+    if (importlib.util.find_spec('zstandard')):
+        import zstandard
+        return zstandard
+    raise ImportError("Could not import zstandard library. Make sure to "
+                      "install omero-cli-transfer with the optional "
+                      "[zstd] addition")
+
+
+def is_incompressible(sample: bytes) -> bool:
+    if not sample:
+        return False
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    return ratio > INCOMPRESSIBLE_RATIO
+
+
+class _ChainReader:
+    # puts an already-read sample back in front of the rest of a stream
+    def __init__(self, head: bytes, reader: BinaryIO):
+        self.head = head
+        self.reader = reader
+
+    def read(self, n: int = -1) -> bytes:
+        if not self.head:
+            return self.reader.read(n)
+        if n is None or n < 0:
+            data, self.head = self.head + self.reader.read(), b""
+            return data
+        data, self.head = self.head[:n], self.head[n:]
+        if len(data) < n:
+            data += self.reader.read(n - len(data))
+        return data
+
+
+class _PaddedReader:
+    # reads exactly `size` bytes: if the stream fails or ends early, the
+    # rest of the member is zero-filled so the archive stays well-formed
+    def __init__(self, reader: BinaryIO, size: int):
+        self.reader = reader
+        self.remaining = size
+        self.error: Optional[BaseException] = None
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            n = self.remaining
+        n = min(n, self.remaining)
+        data = b""
+        if self.error is None:
+            try:
+                data = self.reader.read(n)
+            except Exception as e:
+                self.error = e
+            if not data and n and self.error is None:
+                self.error = EOFError("unexpected end of data")
+        if not data:
+            data = b"\0" * n
+        self.remaining -= len(data)
+        return data
+
+
+class ParallelCompressor:
+    """
+    Writable stream that compresses fixed-size chunks on `threads` threads
+    as independent gzip members or zstd frames, which gzip/zstd readers
+    (and tarfile) treat as a single stream. With `store` set, chunks are
+    written without (or with the cheapest) compression.
+    """
+
+    def __init__(self, fileobj: BinaryIO, format: str,
+                 level: Optional[int] = None, threads: Optional[int] = None):
+        if format not in COMPRESS_FORMATS:
+            raise ValueError(f"Unknown compression format {format}")
+        self.fileobj = fileobj
+        self.format = format
+        self.threads = threads or os.cpu_count() or 1
+        if format == "tar.zst":
+            self.zstandard = import_zstandard()
+            self.level = 3 if level is None else level
+        else:
+            self.level = 6 if level is None else level
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending: deque = deque()
+        self.buffer = bytearray()
+        self.position = 0
+        self.store = False
+
+    def _compress(self, data: bytes, store: bool) -> bytes:
+        if self.format == "tar.zst":
+            level = ZSTD_STORE_LEVEL if store else self.level
+            return self.zstandard.ZstdCompressor(level=level).compress(data)
+        comp = zlib.compressobj(0 if store else self.level, zlib.DEFLATED,
+                                31)
+        return comp.compress(data) + comp.flush()
+
+    def _submit(self):
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.pending.append(self.pool.submit(self._compress, data,
+                                             self.store))
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def set_store(self, store: bool):
+        if store != self.store:
+            self._submit()
+            self.store = store
+
+    def write(self, data: bytes) -> int:
+        self.buffer.extend(data)
+        self.position += len(data)
+        if len(self.buffer) >= COMPRESS_CHUNK_SIZE:
+            self._submit()
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        self._submit()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.fileobj.close()
+
+
+class ArchiveWriter:
+    """
+    Writes a pack straight into a tar or zip file, as `shutil.make_archive`
+    would have from the staging `root` folder, without the files having
+    to be written there first.
+
+    Members are added from readable streams of known size, one at a time;
+    `add_folder` adds whatever was written to `root` itself (e.g. figures
+    and transfer.xml), with transfer.xml last.
+
+    `compress` ("tar.gz" or "tar.zst") writes a compressed tar through a
+    ParallelCompressor; `level` applies to it or to the zip. Large members
+    that do not compress are stored as they are.
+    """
+
+    def __init__(self, path: str, zip: bool, root: str,
+                 compress: Optional[str] = None, level: Optional[int] = None,
+                 threads: Optional[int] = None):
+        self.path = path
+        self.zip = zip
+        self.root = root
+        self.names: Set[str] = set()
+        self.lock = threading.Lock()
+        self.compressor: Optional[ParallelCompressor] = None
+        if zip:
+            self.archive = ZipFile(path, 'w', ZIP_DEFLATED,
+                                   compresslevel=level)
+        elif compress:
+            if compress == "tar.zst":
+                import_zstandard()
+            self.compressor = ParallelCompressor(open(path, 'wb'), compress,
+                                                 level, threads)
+            self.archive = tarfile.open(fileobj=self.compressor, mode='w')
+        else:
+            self.archive = tarfile.open(path, 'w')
+
+    def name_of(self, target: str) -> str:
+        return Path(os.path.relpath(target, self.root)).as_posix()
+
+    def contains(self, target: str) -> bool:
+        return self.name_of(target) in self.names
+
+    def add(self, target: str, size: int, reader: BinaryIO):
+        """
+        Add `size` bytes from `reader` as the member for `target`, a path
+        under `root`. If the reader fails part way through a member, the
+        rest of the member is zero-filled, so the archive stays usable,
+        and a RuntimeError is raised.
+        """
+        name = self.name_of(target)
+        store = False
+        if (self.zip or self.compressor) and size >= SAMPLE_MIN_SIZE:
+            sample = reader.read(SAMPLE_SIZE)
+            store = is_incompressible(sample)
+            reader = _ChainReader(sample, reader)
+        if size <= MEMBER_BUFFER_SIZE:
+            reader = io.BytesIO(reader.read(size))
+        padded = _PaddedReader(reader, size)
+        with self.lock:
+            self._write(name, size, padded, store)
+            self.names.add(name)
+        if padded.error is not None:
+            raise RuntimeError(f"Could not write {name} to {self.path}: "
+                               f"{padded.error}") from padded.error
+
+    def _write(self, name: str, size: int, reader: BinaryIO, store: bool):
+        if self.zip:
+            if store:
+                info = ZipInfo(name, time.localtime()[:6])
+                info.compress_type = ZIP_STORED
+                info.file_size = size
+                dest = self.archive.open(info, 'w')
+            else:
+                # a name (not a ZipInfo) picks up the archive's level
+                dest = self.archive.open(
+                    name, 'w', force_zip64=size * 1.05 > ZIP64_LIMIT)
+            with dest:
+                shutil.copyfileobj(reader, dest)
+        else:
+            if self.compressor is not None:
+                self.compressor.set_store(store)
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(time.time())
+            self.archive.addfile(info, reader)
+
+    def add_folder(self, folder: str):
+        files = []
+        for path, _, filenames in os.walk(folder):
+            for f in filenames:
+                files.append(os.path.join(path, f))
+        files.sort(key=lambda f: (self.name_of(f) == "transfer.xml", f))
+        for f in files:
+            with open(f, 'rb') as reader:
+                self.add(f, os.path.getsize(f), reader)
+
+    def close(self):
+        self.archive.close()
+        if self.compressor is not None:
+            self.compressor.close()
+
+    def abort(self):
+        try:
+            self.close()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+READ_SIZE = 1024 * 1024
+
+
+class _HashingReader:
+    # sequential reader that hashes everything read through it
+    def __init__(self, fileobj: BinaryIO, hash):
+        self.fileobj = fileobj
+        self.hash = hash
+        self.position = 0
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.fileobj.read(n)
+        self.hash.update(data)
+        self.position += len(data)
+        return data
+
+    def skip_to(self, offset: int):
+        while self.position < offset:
+            if not self.read(min(READ_SIZE, offset - self.position)):
+                raise ValueError("Unexpected end of archive")
+
+    def drain(self):
+        while self.read(READ_SIZE):
+            pass
+
+
+def _safe_path(folder: str, name: str) -> str:
+    # same rules as ZipFile.extract: no absolute paths or `..`
+    parts = [p for p in PurePosixPath(name).parts
+             if p not in ('', '.', '..', '/')]
+    return os.path.join(folder, *parts)
+
+
+def _extract_tar(filepath: str, folder: str, compress: Optional[str],
+                 hash):
+    with open(filepath, 'rb') as fh:
+        reader = _HashingReader(fh, hash)
+        if compress == "tar.zst":
+            stream = import_zstandard().ZstdDecompressor().stream_reader(
+                reader, read_across_frames=True)
+            mode = 'r|'
+        elif compress == "tar.gz":
+            # packs are written as many gzip members; GzipFile reads them
+            # all, tarfile's own 'r|gz' stops after the first
+            stream, mode = gzip.GzipFile(fileobj=reader), 'r|'
+        else:
+            stream, mode = reader, 'r|'
+        with tarfile.open(fileobj=stream, mode=mode) as tf:
+            if hasattr(tarfile, 'data_filter'):
+                tf.extractall(folder, filter='data')
+            else:
+                tf.extractall(folder)
+        reader.drain()
+
+
+def _inflate_member(info: ZipInfo, target: str, chunks):
+    # `chunks` yields the raw (compressed) data of the member; it is
+    # always consumed to the end so the reading thread never blocks
+    chunks = iter(chunks)
+    try:
+        _write_member(info, target, chunks)
+    finally:
+        for _ in chunks:
+            pass
+
+
+def _write_member(info: ZipInfo, target: str, chunks):
+    crc = 0
+    error = None
+    decomp = None
+    if info.compress_type == ZIP_DEFLATED:
+        decomp = zlib.decompressobj(-15)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as out:
+        for chunk in chunks:
+            if error is not None:
+                continue
+            try:
+                data = decomp.decompress(chunk) if decomp else chunk
+                crc = zlib.crc32(data, crc)
+                out.write(data)
+            except Exception as e:
+                error = e
+        if error is None and decomp is not None:
+            data = decomp.flush()
+            crc = zlib.crc32(data, crc)
+            out.write(data)
+    if error is not None:
+        raise error
+    if crc != info.CRC:
+        raise ValueError(f"Bad CRC-32 for {info.filename}")
+
+
+def _queue_iter(chunks: "queue.Queue"):
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _extract_zip(filepath: str, folder: str, workers: int, hash):
+    """
+    Reads the zip once, in order, hashing it and handing the raw data of
+    each stored or deflated member to a pool of `workers` threads that
+    inflate and write it. Other members are extracted by ZipFile after
+    the pass (reading only those members again).
+    """
+    with ZipFile(filepath) as zf:
+        infos = sorted(zf.infolist(), key=lambda i: i.header_offset)
+    fallback = []
+    futures = []
+    slots = threading.Semaphore(2 * workers)
+
+    def run(info: ZipInfo, target: str, chunks):
+        try:
+            _inflate_member(info, target, chunks)
+        finally:
+            slots.release()
+
+    with open(filepath, 'rb') as fh, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        reader = _HashingReader(fh, hash)
+        for info in infos:
+            target = _safe_path(folder, info.filename)
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            if info.compress_type not in (ZIP_STORED, ZIP_DEFLATED) or \
+                    info.flag_bits & 0x1:
+                fallback.append(info)
+                continue
+            reader.skip_to(info.header_offset)
+            header = struct.unpack(structFileHeader,
+                                   reader.read(sizeFileHeader))
+            if header[0] != stringFileHeader:
+                raise ValueError(f"Bad local header for {info.filename}")
+            reader.read(header[10] + header[11])
+            slots.acquire()
+            if info.compress_size <= MEMBER_BUFFER_SIZE:
+                data = reader.read(info.compress_size)
+                futures.append(pool.submit(run, info, target, [data]))
+                continue
+            chunks: queue.Queue = queue.Queue(maxsize=8)
+            futures.append(pool.submit(run, info, target,
+                                       _queue_iter(chunks)))
+            remaining = info.compress_size
+            try:
+                while remaining > 0:
+                    data = reader.read(min(READ_SIZE, remaining))
+                    if not data:
+                        break
+                    chunks.put(data)
+                    remaining -= len(data)
+            finally:
+                # the worker waits for this even if reading failed
+                chunks.put(None)
+        reader.drain()
+        for future in futures:
+            future.result()
+    if fallback:
+        with ZipFile(filepath) as zf:
+            for info in fallback:
+                zf.extract(info, folder)
+
+
+def extract_archive(filepath: str, folder: str,
+                    workers: Optional[int] = None) -> str:
+    """
+    Extract a zip, tar, tar.gz or tar.zst pack into `folder` and return
+    the MD5 of the pack file, reading it from disk only once.
+    """
+    md5 = hashlib.md5()
+    name = Path(filepath).name
+    if name.endswith(".zip"):
+        _extract_zip(filepath, folder, workers or os.cpu_count() or 1, md5)
+    elif name.endswith(".tar"):
+        _extract_tar(filepath, folder, None, md5)
+    else:
+        compress = next((c for c in COMPRESS_FORMATS
+                         if name.endswith("." + c)), None)
+        if compress is None:
+            raise ValueError("File is not a zip, tar, tar.gz or tar.zst"
+                             " file")
+        _extract_tar(filepath, folder, compress, md5)
+    return md5.hexdigest()
+
+
+class PackReader:
+    """
+    Random access to the members of a zip or uncompressed tar pack, through
+    the zip central directory or an index of tar member offsets, so that
+    parts of it can be extracted only when they are needed.
+
+    Compressed tars cannot be read this way, as they have to be inflated
+    from the start to reach a member. Extractions from several threads are
+    done one at a time.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.members: Dict[Tuple[str, ...], object] = {}
+        name = Path(filepath).name
+        if name.endswith(".zip"):
+            self.archive = ZipFile(filepath)
+            for info in self.archive.infolist():
+                self.members[self._key(info.filename)] = info
+        elif name.endswith(".tar"):
+            # headers are read by seeking over member data
+            self.archive = tarfile.open(filepath, 'r:')
+            for member in self.archive.getmembers():
+                self.members[self._key(member.name)] = member
+        else:
+            raise ValueError("On-demand extraction needs a zip or an "
+                             "uncompressed tar file")
+        self.members.pop((), None)
+
+    @staticmethod
+    def _key(name: str) -> Tuple[str, ...]:
+        return tuple(p for p in PurePosixPath(name).parts
+                     if p not in ('', '.', '..', '/'))
+
+    def _matches(self, prefix: str) -> List[Tuple[str, ...]]:
+        parts = self._key(prefix)
+        return [k for k in self.members if k[:len(parts)] == parts]
+
+    def _extract_member(self, key: Tuple[str, ...], folder: str
+                        ) -> Optional[str]:
+        member = self.members[key]
+        target = os.path.join(folder, *key)
+        if isinstance(member, ZipInfo):
+            if member.is_dir():
+                os.makedirs(target, exist_ok=True)
+                return None
+            source = self.archive.open(member)
+        else:
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+                return None
+            if not member.isfile():
+                return None
+            source = self.archive.extractfile(member)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with source, open(target, 'wb') as dest:
+            shutil.copyfileobj(source, dest, READ_SIZE)
+        return target
+
+    def extract(self, prefix: str, folder: str) -> List[str]:
+        """
+        Extract the member `prefix` (or every member under it, if it is a
+        folder) into `folder` and return the paths of the files written.
+        """
+        with self.lock:
+            paths = [self._extract_member(k, folder)
+                     for k in sorted(self._matches(prefix))]
+        return [p for p in paths if p is not None]
+
+    def extract_except(self, prefixes: List[str], folder: str
+                       ) -> List[str]:
+        """
+        Extract every member that is not under one of `prefixes` and
+        return the paths of the files written.
+        """
+        skipped: Set[Tuple[str, ...]] = set()
+        for prefix in prefixes:
+            skipped.update(self._matches(prefix))
+        paths = [self._extract_member(key, folder)
+                 for key in sorted(self.members) if key not in skipped]
+        return [p for p in paths if p is not None]
+
+    def md5(self, stop: Optional[threading.Event] = None
+            ) -> Optional[str]:
+        """ MD5 of the pack file, or None if `stop` is set meanwhile. """
+        md5 = hashlib.md5()
+        with open(self.filepath, 'rb') as fh:
+            reader = _HashingReader(fh, md5)
+            while reader.read(READ_SIZE):
+                if stop is not None and stop.is_set():
+                    return None
+        return md5.hexdigest()
+
+    def close(self):
+        self.archive.close()
+
+
+def _file_checksum(path: str, algorithm: str) -> Tuple[int, str]:
+    hash = hashlib.new(algorithm)
+    with open(path, 'rb') as fh:
+        _HashingReader(fh, hash).drain()
+    return os.path.getsize(path), hash.hexdigest()
+
+
+def verify_files(folder: str, checksums: Dict[str, Dict[str, str]],
+                 paths: Optional[List[str]] = None,
+                 workers: Optional[int] = None):
+    """
+    Check files unpacked into `folder` against the sizes and MD5s (or
+    SHA-1s) recorded for them, by pack path, in `checksums`. Only `paths`
+    are checked if given (files without a record are skipped), otherwise
+    every recorded file. Raises ValueError naming the files that are
+    missing, differ, or were recorded as failed when the pack was made.
+    """
+    root = os.path.abspath(folder)
+    if paths is None:
+        names = list(checksums)
+    else:
+        names = [Path(os.path.relpath(os.path.abspath(p), root)).as_posix()
+                 for p in paths]
+        names = [n for n in names if n in checksums]
+
+    def check(name: str) -> Optional[str]:
+        rec = checksums[name]
+        if rec.get("failed") == "true":
+            return f"{name} (failed when packed)"
+        algorithm = "md5" if rec.get("md5") else "sha1"
+        target = os.path.join(root, *PurePosixPath(name).parts)
+        if not os.path.isfile(target):
+            return f"{name} (missing)"
+        size, digest = _file_checksum(target, algorithm)
+        if str(size) != str(rec["size"]) or digest != rec.get(algorithm):
+            return f"{name} ({algorithm} {digest}, expected "\
+                   f"{rec.get(algorithm)})"
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) \
+            as pool:
+        failed = [f for f in pool.map(check, names) if f is not None]
+    if failed:
+        raise ValueError("Files failed verification: " + ", ".join(failed))
+
+
+def remove_extracted(paths: List[str], folder: str):
+    """
+    Delete extracted files, and the folders they leave empty below
+    `folder`.
+    """
+    root = os.path.abspath(folder)
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+        parent = os.path.dirname(os.path.abspath(path))
+        while parent != root and parent.startswith(root + os.sep):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
@@ -0,0 +1,350 @@
+# Copyright (C) 2022 The Jackson Laboratory
+# All rights reserved.
+#
+# Use is subject to license terms supplied in LICENSE.
+
+from omero.gateway import BlitzGateway
+from omero.rtypes import unwrap
+from omero.cli import NonZeroReturnCode
+from omero.constants.permissions import BINARYACCESS
+from omero.model import OriginalFile
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+from archive_files import ArchiveWriter
+from omero_queries import query_by_ids
+import hashlib
+import json
+import omero
+import os
+import shutil
+import threading
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DEFAULT_READAHEAD = 4
+MANIFEST_NAME = ".transfer_manifest.jsonl"
+MANIFEST_METADATA_NAME = ".transfer_manifest.xml"
+
+
+class DownloadManifest:
+    """
+    Append-only record, kept in the staging folder, of the generated
+    metadata and of every file that was completely downloaded (relative
+    path, size, SHA-1 and MD5), so an interrupted pack can be resumed.
+
+    The first line holds the pack options and the path -> object id map;
+    the OME metadata itself is kept next to it in MANIFEST_METADATA_NAME.
+    A truncated last line (from a crash mid-write) is ignored.
+    """
+
+    def __init__(self, folder: str, options: Dict[str, Any]):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self.metadata_path = os.path.join(folder, MANIFEST_METADATA_NAME)
+        self.options = options
+        self.id_list: Optional[Dict[str, str]] = None
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            self._read()
+
+    def _read(self):
+        with open(self.path, 'rb') as fp:
+            lines = fp.read().splitlines(keepends=True)
+        records = []
+        valid = 0
+        for line in lines:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("incomplete line")
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            valid += len(line)
+        if valid < sum(len(line) for line in lines):
+            # drop the broken tail, so new records start on a fresh line
+            with open(self.path, 'r+b') as fp:
+                fp.truncate(valid)
+        if not records or "options" not in records[0]:
+            return
+        if records[0]["options"] != self.options:
+            raise ValueError(f"{self.folder} was staged for a different "
+                             "pack; remove it or run without --resume")
+        if os.path.exists(self.metadata_path):
+            self.id_list = records[0]["id_list"]
+        for rec in records[1:]:
+            self.files[rec["path"]] = rec
+
+    def save_metadata(self, ome_xml: str, id_list: Dict[str, str]):
+        with open(self.metadata_path + ".tmp", 'w') as fp:
+            fp.write(ome_xml)
+        os.replace(self.metadata_path + ".tmp", self.metadata_path)
+        self.id_list = id_list
+        self.files = {}
+        with open(self.path, 'w') as fp:
+            fp.write(json.dumps({"options": self.options,
+                                 "id_list": id_list}) + "\n")
+
+    def get(self, target: str) -> Optional[Dict[str, Any]]:
+        """
+        The record for `target`, if its download was completed and the
+        file on disk still has the recorded size and SHA-1.
+        """
+        rec = self.files.get(os.path.relpath(target, self.folder))
+        if (rec is None or not os.path.exists(target)
+                or os.path.getsize(target) != rec["size"]):
+            return None
+        sha1 = hashlib.sha1()
+        with open(target, 'rb') as fp:
+            for block in iter(lambda: fp.read(DEFAULT_BLOCK_SIZE), b""):
+                sha1.update(block)
+        if sha1.hexdigest() != rec["sha1"]:
+            return None
+        return rec
+
+    def add(self, target: str, checksums: Dict[str, Any]):
+        rec = dict(checksums, path=os.path.relpath(target, self.folder))
+        with self.lock:
+            self.files[rec["path"]] = rec
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps(rec) + "\n")
+
+    def remove(self):
+        for path in (self.path, self.metadata_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class BlockReader:
+    """
+    Readable stream over a RawFileStore (or Exporter) of known size that
+    keeps up to `readahead` asynchronous reads of `block_size` bytes in
+    flight, and computes SHA-1 and MD5 of the data as it is read.
+    """
+
+    def __init__(self, store, size: int, block_size: int, readahead: int):
+        self.store = store
+        self.size = size
+        self.block_size = block_size
+        self.readahead = readahead
+        self.offset = 0
+        self.pending: deque = deque()
+        self.buffer = b""
+        self.sha1 = hashlib.sha1()
+        self.md5 = hashlib.md5()
+
+    def _next_block(self) -> bytes:
+        while self.offset < self.size and len(self.pending) < self.readahead:
+            length = min(self.block_size, self.size - self.offset)
+            self.pending.append(self.store.begin_read(self.offset, length))
+            self.offset += length
+        if not self.pending:
+            return b""
+        block = self.store.end_read(self.pending.popleft())
+        self.sha1.update(block)
+        self.md5.update(block)
+        return block
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            n = self.size
+        chunks = [self.buffer]
+        available = len(self.buffer)
+        while available < n:
+            block = self._next_block()
+            if not block:
+                break
+            chunks.append(block)
+            available += len(block)
+        data = b"".join(chunks)
+        self.buffer = data[n:]
+        return data[:n]
+
+    def checksums(self) -> Dict[str, Any]:
+        return {"size": self.size, "sha1": self.sha1.hexdigest(),
+                "md5": self.md5.hexdigest()}
+
+
+class FileDownloader:
+    """
+    Streams OriginalFiles (and OME-TIFF exports of images without a
+    fileset) to disk over an already-open BlitzGateway session, instead of
+    going through the `download`/`export` CLI plugins once per file.
+
+    Up to `readahead` blocks of `block_size` bytes are requested ahead of
+    the one being written. Each transfer uses its own service, so a single
+    downloader can be shared by several threads. With a `manifest`, files
+    it lists as complete are skipped and new ones are recorded in it; with
+    an `archive`, files are written into it instead of to disk.
+
+    Checksums of every file are kept in `files` (by target path); files
+    whose server-side hash is SHA-1 or MD5 are checked against it. Pack
+    members that could not be written in full, or that do not match the
+    server's hash, are kept there with `failed` set.
+    """
+
+    def __init__(self, conn: BlitzGateway,
+                 block_size: int = DEFAULT_BLOCK_SIZE,
+                 readahead: int = DEFAULT_READAHEAD,
+                 manifest: Optional[DownloadManifest] = None,
+                 archive: Optional[ArchiveWriter] = None):
+        self.conn = conn
+        self.manifest = manifest
+        self.archive = archive
+        self.block_size = max(1, block_size)
+        self.readahead = max(1, readahead)
+        self.ctx = {'omero.group': '-1'}
+        self.fileset_files: Dict[int, List[Tuple[str, OriginalFile]]] = {}
+        self.annotation_files: Dict[int, OriginalFile] = {}
+        self.files: Dict[str, Dict[str, Any]] = {}
+
+    def _find_all(self, query: str, ids: List[int]) -> list:
+        return query_by_ids(self.conn, query, ids, ctx=self.ctx)
+
+    def load_filesets(self, fs_ids: List[int]):
+        """
+        Fetch the original files of all given filesets in one go, with
+        their path relative to the fileset's template prefix.
+        """
+        missing = [i for i in set(fs_ids) if i not in self.fileset_files]
+        for fs_id in missing:
+            self.fileset_files[fs_id] = []
+        entries = self._find_all(
+            "SELECT fe FROM FilesetEntry fe JOIN FETCH fe.fileset"
+            " JOIN FETCH fe.originalFile o LEFT OUTER JOIN FETCH o.hasher"
+            " WHERE fe.fileset.id IN (:ids) ORDER BY fe.id", missing)
+        for fe in entries:
+            fs = fe.fileset
+            prefix = fs.templatePrefix.val if fs.templatePrefix else ""
+            ofile = fe.originalFile
+            rel_path = ofile.path.val.replace(prefix, "")
+            self.fileset_files[fs.id.val].append((rel_path, ofile))
+
+    def load_annotations(self, ann_ids: List[int]):
+        missing = [i for i in set(ann_ids) if i not in self.annotation_files]
+        anns = self._find_all(
+            "SELECT fa FROM FileAnnotation fa JOIN FETCH fa.file f"
+            " LEFT OUTER JOIN FETCH f.hasher WHERE fa.id IN (:ids)",
+            missing)
+        for fa in anns:
+            self.annotation_files[fa.id.val] = fa.file
+
+    def fileset_targets(self, fs_id: int, dir_path: str
+                        ) -> List[Tuple[str, OriginalFile]]:
+        """
+        Same layout as `omero download Image:<id> <dir_path>`.
+        """
+        self.load_filesets([fs_id])
+        return [(os.path.join(dir_path, rel_path, ofile.name.val), ofile)
+                for rel_path, ofile in self.fileset_files[fs_id]]
+
+    def download_fileset(self, fs_id: int, dir_path: str):
+        """
+        Files that already exist (or, with a manifest, that it lists) are
+        skipped.
+        """
+        for target, ofile in self.fileset_targets(fs_id, dir_path):
+            if self.archive is not None:
+                if not self.archive.contains(target):
+                    self.download_file(ofile, target)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if self.manifest is not None or not os.path.exists(target):
+                self.download_file(ofile, target)
+
+    def download_annotation(self, ann_id: int, target: str):
+        self.load_annotations([ann_id])
+        if ann_id not in self.annotation_files:
+            raise NonZeroReturnCode(601, "No FileAnnotation with input ID")
+        self.download_file(self.annotation_files[ann_id], target)
+
+    def _resume(self, target: str) -> bool:
+        if self.manifest is None:
+            return False
+        rec = self.manifest.get(target)
+        if rec is not None:
+            self.files[target] = rec
+        return rec is not None
+
+    def download_file(self, ofile: OriginalFile, target: str):
+        if self._resume(target):
+            return
+        perms = ofile.details.permissions
+        if perms is not None and perms.isRestricted(BINARYACCESS):
+            raise NonZeroReturnCode(66, "Download of OriginalFile:%s is "
+                                        "restricted" % ofile.id.val)
+        store = self.conn.c.sf.createRawFileStore()
+        try:
+            store.setFileId(ofile.id.val, self.ctx)
+            size = store.size()
+            checksums = self._write(store, size, target)
+        except omero.ServerError as se:
+            if os.path.exists(target):
+                os.remove(target)
+            raise NonZeroReturnCode(67, "%s: %s" % (se.__class__.__name__,
+                                                    se.message))
+        finally:
+            store.close()
+        self._verify(ofile, target, checksums)
+        self._record(target, checksums)
+
+    def _verify(self, ofile: OriginalFile, target: str,
+                checksums: Dict[str, Any]):
+        # only SHA-1 and MD5 server hashes have an unambiguous hex form
+        hasher = None
+        if ofile.hasher is not None and ofile.hasher.isLoaded():
+            hasher = unwrap(ofile.hasher.value)
+        key = {"SHA1-160": "sha1", "MD5-128": "md5"}.get(hasher)
+        expected = unwrap(ofile.hash)
+        if not key or not expected or expected == checksums[key]:
+            return
+        msg = ("Checksum mismatch for OriginalFile:%s (%s %s, expected %s)"
+               % (ofile.id.val, hasher, checksums[key], expected))
+        if self.archive is not None:
+            # the data is already in the pack: record the server's hash
+            # so the file fails verification on unpack
+            self._record_failed(target, {"size": checksums["size"],
+                                         key: expected})
+            raise RuntimeError(msg)
+        os.remove(target)
+        raise NonZeroReturnCode(68, msg)
+
+    def _record(self, target: str, checksums: Dict[str, Any]):
+        self.files[target] = checksums
+        if self.manifest is not None:
+            self.manifest.add(target, checksums)
+
+    def _record_failed(self, target: str, checksums: Dict[str, Any]):
+        # a pack member whose content is known to be bad
+        self.files[target] = dict(checksums, failed=True)
+
+    def export_image(self, img_id: int, target: str):
+        """ Same output as `omero export --file <target> Image:<id>`. """
+        if self._resume(target):
+            return
+        exporter = self.conn.c.sf.createExporter()
+        try:
+            exporter.addImage(img_id)
+            size = exporter.generateTiff(self.ctx)
+            checksums = self._write(exporter, size, target)
+        except omero.ServerError as se:
+            if os.path.exists(target):
+                os.remove(target)
+            raise NonZeroReturnCode(1, "%s: %s" % (se.__class__.__name__,
+                                                   se.message))
+        finally:
+            exporter.close()
+        self._record(target, checksums)
+
+    def _write(self, store, size: int, target: str) -> Dict[str, Any]:
+        reader = BlockReader(store, size, self.block_size, self.readahead)
+        if self.archive is not None:
+            try:
+                self.archive.add(target, size, reader)
+            except RuntimeError:
+                if self.archive.contains(target):
+                    self._record_failed(target, {"size": size})
+                raise
+        else:
+            with open(target, 'wb') as handle:
+                shutil.copyfileobj(reader, handle, self.block_size)
+        return reader.checksums()
@@ -5,8 +5,17 @@
 
 import ezomero
 from ome_types import to_xml
-from typing import List, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 from omero.model import DatasetI, IObject, PlateI, WellI, WellSampleI, ImageI
+from omero.model import TagAnnotationI, MapAnnotationI, CommentAnnotationI
+from omero.model import LongAnnotationI, FileAnnotationI, OriginalFileI
+from omero.model import NamedValue, ProjectI, ScreenI, RoiI, LengthI
+from omero.model import PointI, LineI, RectangleI, EllipseI, PolygonI
+from omero.model import PolylineI, LabelI
+from omero.model.enums import UnitsLength
+from omero.model import ProjectAnnotationLinkI, DatasetAnnotationLinkI
+from omero.model import ImageAnnotationLinkI, ScreenAnnotationLinkI
+from omero.model import PlateAnnotationLinkI, WellAnnotationLinkI
 from omero.gateway import DatasetWrapper
 from ome_types.model import TagAnnotation, MapAnnotation, FileAnnotation, ROI
 from ome_types.model import CommentAnnotation, LongAnnotation, Annotation
@@ -14,30 +23,118 @@ from ome_types.model import Line, Point, Rectangle, Ellipse, Polygon, Shape
 from ome_types.model import Polyline, Label, Project, Screen, Dataset, OME
 from ome_types.model import Image, Plate, XMLAnnotation, AnnotationRef
 from ome_types.model.simple_types import Marker
-from omero.gateway import TagAnnotationWrapper, MapAnnotationWrapper
-from omero.gateway import CommentAnnotationWrapper, LongAnnotationWrapper
-from omero.gateway import FileAnnotationWrapper, OriginalFileWrapper
+from omero.gateway import OriginalFileWrapper
 from omero.sys import Parameters
-from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, RStringI, rint
-from ezomero import rois
+from omero.gateway import BlitzGateway, omero_type
+from omero.rtypes import rstring, RStringI, rint, rlong, unwrap
+from omero.rtypes import rdouble
+from omero_queries import query_by_ids, roi_pages, ROI_PAGE_SIZE
+from ome_index import OMEIndex, ServerPathIndex
 from pathlib import Path
 import xml.etree.cElementTree as ETree
 import os
 import copy
 import re
 
+SAVE_BATCH_SIZE = 1000
+# OMERO RGBA defaults for shapes without colours (transparent fill,
+# white stroke for Points and yellow for other shapes, as before)
+DEFAULT_FILL_COLOR = 0
+DEFAULT_STROKE_COLOR = -65281
+DEFAULT_POINT_STROKE_COLOR = -1
+
+
+class ContainerCatalog:
+    """
+    Name-keyed view of the current user's Projects, Screens and Datasets
+    (with the Datasets under each Project name, plus the orphaned ones),
+    loaded with one projection query per kind on first use, for `--merge`
+    lookups. Containers created during the unpack are added to it.
+
+    As with scanning the containers one by one, the last match wins.
+    """
+
+    def __init__(self, conn: BlitzGateway):
+        self.conn = conn
+        self.owner = conn.getUser().getId()
+        self.projects: Optional[Dict[str, int]] = None
+        self.project_datasets: Dict[Tuple[str, str], int] = {}
+        self.screens: Optional[Dict[str, int]] = None
+        self.orphans: Optional[Dict[str, int]] = None
+
+    def _query(self, query: str) -> List[list]:
+        params = Parameters()
+        params.map = {"owner": rlong(self.owner)}
+        results = self.conn.getQueryService().projection(
+            query, params, self.conn.SERVICE_OPTS)
+        return [[unwrap(v) for v in row] for row in results]
+
+    def _load_projects(self):
+        self.projects = {}
+        for pj_id, pj_name, ds_id, ds_name in self._query(
+                "SELECT p.id, p.name, d.id, d.name FROM Project p"
+                " LEFT OUTER JOIN p.datasetLinks l LEFT OUTER JOIN l.child d"
+                " WHERE p.details.owner.id = :owner ORDER BY p.id, d.id"):
+            self.projects[pj_name] = pj_id
+            if ds_id is not None:
+                self.project_datasets[(pj_name, ds_name)] = ds_id
+
+    def find_project(self, name: str) -> int:
+        if self.projects is None:
+            self._load_projects()
+        return self.projects.get(name, 0)
+
+    def find_project_dataset(self, pj_name: str, ds_name: str) -> int:
+        if self.projects is None:
+            self._load_projects()
+        return self.project_datasets.get((pj_name, ds_name), 0)
+
+    def find_screen(self, name: str) -> int:
+        if self.screens is None:
+            self.screens = {n: i for i, n in self._query(
+                "SELECT s.id, s.name FROM Screen s"
+                " WHERE s.details.owner.id = :owner ORDER BY s.id")}
+        return self.screens.get(name, 0)
+
+    def find_orphaned_dataset(self, name: str) -> int:
+        if self.orphans is None:
+            self.orphans = {n: i for i, n in self._query(
+                "SELECT d.id, d.name FROM Dataset d"
+                " WHERE d.details.owner.id = :owner AND NOT EXISTS"
+                " (SELECT l FROM ProjectDatasetLink l WHERE l.child = d)"
+                " ORDER BY d.id")}
+        return self.orphans.get(name, 0)
+
+    def add_project(self, name: str, pj_id: int):
+        if self.projects is None:
+            self._load_projects()
+        self.projects[name] = pj_id
+
+    def add_screen(self, name: str, scr_id: int):
+        self.find_screen(name)
+        self.screens[name] = scr_id
+
+    def add_orphaned_dataset(self, name: str, ds_id: int):
+        # new Datasets stay orphaned until link_datasets runs
+        self.find_orphaned_dataset(name)
+        self.orphans[name] = ds_id
+
 
 def create_or_set_projects(pjs: List[Project], conn: BlitzGateway,
-                           merge: bool) -> dict:
+                           merge: bool,
+                           catalog: Optional[ContainerCatalog] = None
+                           ) -> dict:
     pj_map = {}
     if not merge:
         pj_map = create_projects(pjs, conn)
     else:
+        if catalog is None:
+            catalog = ContainerCatalog(conn)
         for pj in pjs:
-            pj_id = find_project(pj, conn)
+            pj_id = find_project(pj, conn, catalog)
             if not pj_id:
                 pj_id = ezomero.post_project(conn, pj.name, pj.description)
+                catalog.add_project(pj.name, pj_id)
             pj_map[pj.id] = pj_id
     return pj_map
 
@@ -50,25 +147,27 @@ def create_projects(pjs: List[Project], conn: BlitzGateway) -> dict:
     return pj_map
 
 
-def find_project(pj: Project, conn: BlitzGateway) -> int:
-    id = 0
-    my_exp_id = conn.getUser().getId()
-    for p in conn.getObjects("Project", opts={'owner': my_exp_id}):
-        if p.getName() == pj.name:
-            id = p.getId()
-    return id
+def find_project(pj: Project, conn: BlitzGateway,
+                 catalog: Optional[ContainerCatalog] = None) -> int:
+    if catalog is None:
+        catalog = ContainerCatalog(conn)
+    return catalog.find_project(pj.name)
 
 
-def create_or_set_screens(scrs: List[Screen], conn: BlitzGateway, merge: bool
+def create_or_set_screens(scrs: List[Screen], conn: BlitzGateway, merge: bool,
+                          catalog: Optional[ContainerCatalog] = None
                           ) -> dict:
     scr_map = {}
     if not merge:
         scr_map = create_screens(scrs, conn)
     else:
+        if catalog is None:
+            catalog = ContainerCatalog(conn)
         for scr in scrs:
-            scr_id = find_screen(scr, conn)
+            scr_id = find_screen(scr, conn, catalog)
             if not scr_id:
                 scr_id = ezomero.post_screen(conn, scr.name, scr.description)
+                catalog.add_screen(scr.name, scr_id)
             scr_map[scr.id] = scr_id
     return scr_map
 
@@ -81,23 +180,25 @@ def create_screens(scrs: List[Screen], conn: BlitzGateway) -> dict:
     return scr_map
 
 
-def find_screen(sc: Screen, conn: BlitzGateway) -> int:
-    id = 0
-    my_exp_id = conn.getUser().getId()
-    for s in conn.getObjects("Screen", opts={'owner': my_exp_id}):
-        if s.getName() == sc.name:
-            id = s.getId()
-    return id
+def find_screen(sc: Screen, conn: BlitzGateway,
+                catalog: Optional[ContainerCatalog] = None) -> int:
+    if catalog is None:
+        catalog = ContainerCatalog(conn)
+    return catalog.find_screen(sc.name)
 
 
 def create_or_set_datasets(dss: List[Dataset], pjs: List[Project],
-                           conn: BlitzGateway, merge: bool) -> dict:
+                           conn: BlitzGateway, merge: bool,
+                           catalog: Optional[ContainerCatalog] = None
+                           ) -> dict:
     ds_map = {}
     if not merge:
         ds_map = create_datasets(dss, conn)
     else:
+        if catalog is None:
+            catalog = ContainerCatalog(conn)
         for ds in dss:
-            ds_id = find_dataset(ds, pjs, conn)
+            ds_id = find_dataset(ds, pjs, conn, catalog)
             if not ds_id:
                 dataset = DatasetWrapper(conn, DatasetI())
                 dataset.setName(ds.name)
@@ -105,6 +206,7 @@ def create_or_set_datasets(dss: List[Dataset], pjs: List[Project],
                     dataset.setDescription(ds.description)
                 dataset.save()
                 ds_id = dataset.getId()
+                catalog.add_orphaned_dataset(ds.name, ds_id)
             ds_map[ds.id] = ds_id
     return ds_map
 
@@ -126,131 +228,129 @@ def create_datasets(dss: List[Dataset], conn: BlitzGateway) -> dict:
     return ds_map
 
 
-def find_dataset(ds: Dataset, pjs: List[Project], conn: BlitzGateway) -> int:
+def find_dataset(ds: Dataset, pjs: List[Project], conn: BlitzGateway,
+                 catalog: Optional[ContainerCatalog] = None) -> int:
+    if catalog is None:
+        catalog = ContainerCatalog(conn)
     id = 0
-    my_exp_id = conn.getUser().getId()
-    orphan = True
-    for pj in pjs:
-        for dsref in pj.dataset_refs:
-            if dsref.id == ds.id:
-                orphan = False
-    if not orphan:
-        for pj in pjs:
-            for p in conn.getObjects("Project", opts={'owner': my_exp_id}):
-                if p.getName() == pj.name:
-                    for dsref in pj.dataset_refs:
-                        if dsref.id == ds.id:
-                            for ds_rem in p.listChildren():
-                                if ds.name == ds_rem.getName():
-                                    id = ds_rem.getId()
+    parents = [pj for pj in pjs
+               if any(dsref.id == ds.id for dsref in pj.dataset_refs)]
+    if parents:
+        for pj in parents:
+            id = catalog.find_project_dataset(pj.name, ds.name) or id
     else:
-        for d in conn.getObjects("Dataset", opts={'owner': my_exp_id,
-                                                  'orphaned': True}):
-            if d.getName() == ds.name:
-                id = d.getId()
+        id = catalog.find_orphaned_dataset(ds.name)
     return id
 
 
+def save_objects(objs: List[IObject], conn: BlitzGateway,
+                 batch_size: int = SAVE_BATCH_SIZE) -> List[IObject]:
+    """ Saves `objs` with one saveAndReturnArray call per `batch_size`. """
+    update_service = conn.getUpdateService()
+    batch_size = max(1, batch_size)
+    saved = []
+    for start in range(0, len(objs), batch_size):
+        saved.extend(update_service.saveAndReturnArray(
+            objs[start:start + batch_size], conn.SERVICE_OPTS))
+    return saved
+
+
+def _map_annotation(namespace: str, key_value_data: list) -> MapAnnotationI:
+    map_ann = MapAnnotationI()
+    map_ann.ns = omero_type(namespace)
+    map_ann.setMapValue([NamedValue(d[0], d[1]) for d in key_value_data])
+    return map_ann
+
+
 def create_annotations(ans: List[Annotation], conn: BlitzGateway, hash: str,
                        folder: str, figure: bool, img_map: dict,
-                       metadata: List[str]) -> dict:
-    ann_map = {}
+                       metadata: List[str],
+                       batch_size: int = SAVE_BATCH_SIZE,
+                       paths: Optional[ServerPathIndex] = None) -> dict:
+    if paths is None:
+        paths = ServerPathIndex(ans)
+    new_ids = []
+    new_anns = []
     for an in ans:
         if isinstance(an, TagAnnotation):
-            tag_ann = TagAnnotationWrapper(conn)
-            tag_ann.setValue(an.value)
-            tag_ann.setDescription(an.description)
-            tag_ann.save()
-            ann_map[an.id] = tag_ann.getId()
+            tag_ann = TagAnnotationI()
+            tag_ann.textValue = omero_type(an.value)
+            tag_ann.description = omero_type(an.description)
+            new_anns.append(tag_ann)
         elif isinstance(an, MapAnnotation):
-            map_ann = MapAnnotationWrapper(conn)
-            namespace = an.namespace
-            map_ann.setNs(namespace)
             key_value_data = []
             for v in an.value.ms:
                 key_value_data.append([v.k, v.value])
-            map_ann.setValue(key_value_data)
-            map_ann.save()
-            ann_map[an.id] = map_ann.getId()
+            new_anns.append(_map_annotation(an.namespace, key_value_data))
         elif isinstance(an, CommentAnnotation):
-            comm_ann = CommentAnnotationWrapper(conn)
-            comm_ann.setValue(an.value)
-            comm_ann.setDescription(an.description)
-            comm_ann.save()
-            ann_map[an.id] = comm_ann.getId()
+            comm_ann = CommentAnnotationI()
+            comm_ann.textValue = omero_type(an.value)
+            comm_ann.description = omero_type(an.description)
+            new_anns.append(comm_ann)
         elif isinstance(an, LongAnnotation):
-            comm_ann = LongAnnotationWrapper(conn)
-            comm_ann.setValue(an.value)
-            comm_ann.setDescription(an.description)
-            comm_ann.setNs(an.namespace)
-            comm_ann.save()
-            ann_map[an.id] = comm_ann.getId()
+            long_ann = LongAnnotationI()
+            long_ann.longValue = rlong(an.value)
+            long_ann.description = omero_type(an.description)
+            long_ann.ns = omero_type(an.namespace)
+            new_anns.append(long_ann)
         elif isinstance(an, FileAnnotation):
             if an.namespace == "omero.web.figure.json":
                 if not figure:
                     continue
                 else:
-                    update_figure_refs(an, ans, img_map, folder)
-            original_file = create_original_file(an, ans, conn, folder)
-            file_ann = FileAnnotationWrapper(conn)
-            file_ann.setDescription(an.description)
-            file_ann.setNs(an.namespace)
-            file_ann.setFile(original_file)
-            file_ann.save()
-            ann_map[an.id] = file_ann.getId()
+                    update_figure_refs(an, paths, img_map, folder)
+            original_file = create_original_file(an, paths, conn, folder)
+            file_ann = FileAnnotationI()
+            file_ann.description = omero_type(an.description)
+            file_ann.ns = omero_type(an.namespace)
+            file_ann.file = OriginalFileI(original_file.getId(), False)
+            new_anns.append(file_ann)
         elif isinstance(an, XMLAnnotation):
             # pass if path, use if provenance metadata
-            tree = ETree.fromstring(to_xml(an.value,
-                                           canonicalize=True))
-            is_metadata = False
-            for el in tree:
-                if el.tag.rpartition('}')[2] == "CLITransferMetadata":
-                    is_metadata = True
-            if is_metadata:
-                map_ann = MapAnnotationWrapper(conn)
-                namespace = an.namespace
-                map_ann.setNs(namespace)
-                key_value_data = []
-                if not metadata:
-                    key_value_data.append(['empty_metadata', "True"])
-                else:
-                    key_value_data = parse_xml_metadata(an, metadata, hash)
-                map_ann.setValue(key_value_data)
-                map_ann.save()
-                ann_map[an.id] = map_ann.getId()
-    return ann_map
+            if an.id not in paths.metadata:
+                continue
+            key_value_data = []
+            if not metadata:
+                key_value_data.append(['empty_metadata', "True"])
+            else:
+                key_value_data = parse_xml_metadata(paths.metadata[an.id],
+                                                    metadata, hash)
+            new_anns.append(_map_annotation(an.namespace, key_value_data))
+        else:
+            continue
+        new_ids.append(an.id)
+    saved = save_objects(new_anns, conn, batch_size)
+    return {an_id: obj.getId().getValue()
+            for an_id, obj in zip(new_ids, saved)}
 
 
-def parse_xml_metadata(ann: XMLAnnotation,
+def parse_xml_metadata(fields: Dict[str, str],
                        metadata: List[str],
                        hash: str) -> List[List[str]]:
+    """ `fields` are the CLITransferMetadata contents of an annotation. """
     kv_data = []
-    tree = ETree.fromstring(to_xml(ann.value, canonicalize=True))
-    for el in tree:
-        if el.tag.rpartition('}')[2] == "CLITransferMetadata":
-            for el2 in el:
-                item = el2.tag.rpartition('}')[2]
-                val = el2.text
-                if item == "md5" and "md5" in metadata:
-                    kv_data.append(['md5', hash])
-                if item == "origin_image_id" and "img_id" in metadata:
-                    kv_data.append([item, val])
-                if item == "origin_plate_id" and "plate_id" in metadata:
-                    kv_data.append([item, val])
-                if item == "packing_timestamp" and "timestamp" in metadata:
-                    kv_data.append([item, val])
-                if item == "software" and "software" in metadata:
-                    kv_data.append([item, val])
-                if item == "version" and "version" in metadata:
-                    kv_data.append([item, val])
-                if item == "origin_hostname" and "hostname" in metadata:
-                    kv_data.append([item, val])
-                if item == "original_user" and "orig_user" in metadata:
-                    kv_data.append([item, val])
-                if item == "original_group" and "orig_group" in metadata:
-                    kv_data.append([item, val])
-                if item == "database_id" and "db_id" in metadata:
-                    kv_data.append([item, val])
+    for item, val in fields.items():
+        if item == "md5" and "md5" in metadata:
+            # packs from before per-file checksums only have a placeholder
+            kv_data.append(['md5', val if val and val != "TBC" else hash])
+        if item == "origin_image_id" and "img_id" in metadata:
+            kv_data.append([item, val])
+        if item == "origin_plate_id" and "plate_id" in metadata:
+            kv_data.append([item, val])
+        if item == "packing_timestamp" and "timestamp" in metadata:
+            kv_data.append([item, val])
+        if item == "software" and "software" in metadata:
+            kv_data.append([item, val])
+        if item == "version" and "version" in metadata:
+            kv_data.append([item, val])
+        if item == "origin_hostname" and "hostname" in metadata:
+            kv_data.append([item, val])
+        if item == "original_user" and "orig_user" in metadata:
+            kv_data.append([item, val])
+        if item == "original_group" and "orig_group" in metadata:
+            kv_data.append([item, val])
+        if item == "database_id" and "db_id" in metadata:
+            kv_data.append([item, val])
     return kv_data
 
 
@@ -278,10 +378,10 @@ def get_server_path(anrefs: List[AnnotationRef],
     return fpath
 
 
-def update_figure_refs(ann: FileAnnotation, ans: List[Annotation],
+def update_figure_refs(ann: FileAnnotation, paths: ServerPathIndex,
                        img_map: dict, folder: str):
     curr_folder = str(Path('.').resolve())
-    fpath = get_server_path(ann.annotation_refs, ans)
+    fpath = paths.get_server_path(ann)
     if fpath:
         dest_path = str(os.path.join(curr_folder, folder,  '.', fpath))
         with open(dest_path, 'r') as file:
@@ -301,42 +401,32 @@ def update_figure_refs(ann: FileAnnotation, ans: List[Annotation],
     return
 
 
-def create_original_file(ann: FileAnnotation, ans: List[Annotation],
+def create_original_file(ann: FileAnnotation, paths: ServerPathIndex,
                          conn: BlitzGateway, folder: str
                          ) -> OriginalFileWrapper:
     curr_folder = str(Path('.').resolve())
-    fpath = get_server_path(ann.annotation_refs, ans)
+    fpath = paths.get_server_path(ann)
     dest_path = str(os.path.join(curr_folder, folder,  '.', fpath))
     ofile = conn.createOriginalFileFromLocalFile(dest_path)
     return ofile
 
 
-def create_plate_map(ome: OME, img_map: dict, conn: BlitzGateway
+def create_plate_map(ome: OME, img_map: dict, conn: BlitzGateway,
+                     paths: Optional[ServerPathIndex] = None
                      ) -> Tuple[dict, OME]:
+    if paths is None:
+        paths = ServerPathIndex(ome.structured_annotations)
     newome = copy.deepcopy(ome)
+    xml_ids = {ann.id for ann in ome.structured_annotations
+               if isinstance(ann, XMLAnnotation)}
     plate_map = {}
-    map_ref_ids = []
+    map_ref_ids = set()
     for plate in ome.plates:
-        ann_ids = [i.id for i in plate.annotation_refs]
-        for ann in ome.structured_annotations:
-            if (ann.id in ann_ids and
-                    isinstance(ann, XMLAnnotation)):
-                tree = ETree.fromstring(to_xml(ann.value,
-                                               canonicalize=True))
-                is_metadata = False
-                for el in tree:
-                    if el.tag.rpartition('}')[2] == "CLITransferMetadata":
-                        is_metadata = True
-                if not is_metadata:
-                    newome.structured_annotations.remove(ann)
-                    map_ref_ids.append(ann.id)
-                    file_path = get_server_path(plate.annotation_refs,
-                                                ome.structured_annotations)
-                    annref = next(filter(lambda x: x.id == ann.id,
-                                         plate.annotation_refs))
-                    newplate = next(filter(lambda x: x.id == plate.id,
-                                           newome.plates))
-                    newplate.annotation_refs.remove(annref)
+        file_path = paths.get_server_path(plate)
+        # the plate's server path (any non-metadata XMLAnnotation) goes
+        map_ref_ids.update(ref.id for ref in plate.annotation_refs
+                           if ref.id in xml_ids
+                           and ref.id not in paths.metadata)
         q = conn.getQueryService()
         params = Parameters()
         if not file_path:
@@ -379,10 +469,11 @@ def create_plate_map(ome: OME, img_map: dict, conn: BlitzGateway
             # plate was imported as images
             plate_id = create_plate_from_images(plate, img_map, conn)
         plate_map[plate.id] = plate_id
+    xml_anns = newome.structured_annotations.xml_annotations
+    xml_anns[:] = [ann for ann in xml_anns if ann.id not in map_ref_ids]
     for p in newome.plates:
-        for ref in p.annotation_refs:
-            if ref.id in map_ref_ids:
-                p.annotation_refs.remove(ref)
+        p.annotation_refs[:] = [ref for ref in p.annotation_refs
+                                if ref.id not in map_ref_ids]
     return plate_map, newome
 
 
@@ -430,103 +521,256 @@ def add_image_to_plate(image_ids: List[int], plate_id: int, column: int,
     return True
 
 
-def create_shapes(roi: ROI) -> List[Shape]:
+def _shape_to_omero(shape: Shape) -> Optional[IObject]:
+    """ Unsaved OMERO shape with the geometry of `shape`. """
+    if isinstance(shape, Point):
+        sh = PointI()
+        sh.x, sh.y = rdouble(shape.x), rdouble(shape.y)
+    elif isinstance(shape, Line):
+        sh = LineI()
+        sh.x1, sh.y1 = rdouble(shape.x1), rdouble(shape.y1)
+        sh.x2, sh.y2 = rdouble(shape.x2), rdouble(shape.y2)
+        if shape.marker_start == Marker.ARROW:
+            sh.markerStart = rstring("Arrow")
+        if shape.marker_end == Marker.ARROW:
+            sh.markerEnd = rstring("Arrow")
+    elif isinstance(shape, Rectangle):
+        sh = RectangleI()
+        sh.x, sh.y = rdouble(shape.x), rdouble(shape.y)
+        sh.width, sh.height = rdouble(shape.width), rdouble(shape.height)
+    elif isinstance(shape, Ellipse):
+        sh = EllipseI()
+        sh.x, sh.y = rdouble(shape.x), rdouble(shape.y)
+        sh.radiusX = rdouble(shape.radius_x)
+        sh.radiusY = rdouble(shape.radius_y)
+    elif isinstance(shape, Polygon):
+        sh = PolygonI()
+    elif isinstance(shape, Polyline):
+        sh = PolylineI()
+    elif isinstance(shape, Label):
+        sh = LabelI()
+        sh.x, sh.y = rdouble(shape.x), rdouble(shape.y)
+        if shape.font_size is not None:
+            sh.fontSize = LengthI(shape.font_size, UnitsLength.POINT)
+    else:
+        return None
+    if shape.the_z is not None:
+        sh.theZ = rint(shape.the_z)
+    if shape.the_c is not None:
+        sh.theC = rint(shape.the_c)
+    if shape.the_t is not None:
+        sh.theT = rint(shape.the_t)
+    if shape.text is not None:
+        sh.textValue = rstring(shape.text)
+    return sh
+
+
+def _shape_style(shape: Shape) -> Tuple[int, int, float]:
+    """ Fill colour, stroke colour and stroke width OMERO gets for `shape`. """
+    fill = shape.fill_color.as_int32() if shape.fill_color \
+        else DEFAULT_FILL_COLOR
+    if shape.stroke_color:
+        stroke = shape.stroke_color.as_int32()
+    elif isinstance(shape, Point):
+        stroke = DEFAULT_POINT_STROKE_COLOR
+    else:
+        stroke = DEFAULT_STROKE_COLOR
+    width = float(int(shape.stroke_width)) if shape.stroke_width else 1.0
+    return fill, stroke, width
+
+
+def create_roi_objects(rois: List[Tuple[int, ROI]]) -> List[IObject]:
+    """
+    Unsaved RoiI graphs (with their shapes) for (destination image id,
+    ROI) pairs. Colours are taken straight from the packed RGBA integers
+    of the OME colours, and points are written in OMERO's "x,y x,y" form.
+    """
+    roi_objs = []
     shapes = []
-    for shape in roi.union:
-        if shape.fill_color:
-            fc = shape.fill_color.as_rgb_tuple()
-            if len(fc) == 3:
-                fill_color = fc + (255,)
-            else:
-                alpha = fc[3] * 255
-                fill_color = fc[0:3] + (int(alpha),)
-        else:
-            fill_color = (0, 0, 0, 0)
-        if shape.stroke_color:
-            sc = shape.stroke_color.as_rgb_tuple()
-            if len(sc) == 3:
-                stroke_color = sc + (255,)
-            else:
-                stroke_color = sc
-        else:
-            stroke_color = (255, 255, 255, 255)
-        if shape.stroke_width:
-            stroke_width = int(shape.stroke_width)
-        else:
-            stroke_width = 1
-        if isinstance(shape, Point):
-            sh = rois.Point(shape.x, shape.y, z=shape.the_z, c=shape.the_c,
-                            t=shape.the_t, label=shape.text,
-                            fill_color=fill_color, stroke_color=stroke_color,
-                            stroke_width=stroke_width)
-        elif isinstance(shape, Line):
-            if shape.marker_start == Marker.ARROW:
-                mk_start = "Arrow"
-            else:
-                mk_start = str(shape.marker_start)
-            if shape.marker_end == Marker.ARROW:
-                mk_end = "Arrow"
-            else:
-                mk_end = str(shape.marker_end)
-            sh = rois.Line(shape.x1, shape.y1, shape.x2, shape.y2,
-                           z=shape.the_z, c=shape.the_c, t=shape.the_t,
-                           label=shape.text, markerStart=mk_start,
-                           markerEnd=mk_end)
-        elif isinstance(shape, Rectangle):
-            sh = rois.Rectangle(shape.x, shape.y, shape.width, shape.height,
-                                z=shape.the_z, c=shape.the_c, t=shape.the_t,
-                                label=shape.text)
-        elif isinstance(shape, Ellipse):
-            sh = rois.Ellipse(shape.x, shape.y, shape.radius_x, shape.radius_y,
-                              z=shape.the_z, c=shape.the_c, t=shape.the_t,
-                              label=shape.text)
-        elif isinstance(shape, Polygon):
-            points = []
-            for pt in shape.points.split(" "):
-                # points sometimes come with a comma at the end...
-                pt = pt.rstrip(",")
-                points.append(tuple(float(x) for x in pt.split(",")))
-            sh = rois.Polygon(points, z=shape.the_z, c=shape.the_c,
-                              t=shape.the_t, label=shape.text)
-        elif isinstance(shape, Polyline):
-            points = []
-            for pt in shape.points.split(" "):
-                # points sometimes come with a comma at the end...
-                pt = pt.rstrip(",")
-                points.append(tuple(float(x) for x in pt.split(",")))
-            sh = rois.Polyline(points, z=shape.the_z, c=shape.the_c,
-                               t=shape.the_t, label=shape.text)
-        elif isinstance(shape, Label):
-            sh = rois.Label(shape.x, shape.y, z=shape.the_z, c=shape.the_c,
-                            t=shape.the_t, label=shape.text,
-                            fontSize=shape.font_size)
-        else:
-            continue
-        shapes.append(sh)
-    return shapes
+    for img_id, roi in rois:
+        roi_obj = RoiI()
+        roi_obj.setImage(ImageI(img_id, False))
+        if roi.name is not None:
+            roi_obj.setName(rstring(roi.name))
+        if roi.description is not None:
+            roi_obj.setDescription(rstring(roi.description))
+        for shape in roi.union:
+            sh = _shape_to_omero(shape)
+            if sh is not None:
+                roi_obj.addShape(sh)
+                shapes.append((shape, sh))
+        roi_objs.append(roi_obj)
+    for shape, sh in shapes:
+        if isinstance(shape, (Polygon, Polyline)):
+            points = _parse_points(shape.points or "")
+            sh.points = rstring(" ".join(f"{pt[0]},{pt[1]}"
+                                         for pt in points))
+        fill, stroke, width = _shape_style(shape)
+        sh.fillColor = rint(fill)
+        sh.strokeColor = rint(stroke)
+        sh.strokeWidth = LengthI(width, UnitsLength.PIXEL)
+    return roi_objs
+
+
+def post_rois(rois: List[Tuple[int, ROI]], conn: BlitzGateway,
+              batch_size: int = SAVE_BATCH_SIZE) -> List[int]:
+    """ Creates ROIs on destination images, `batch_size` ROIs per call. """
+    ids = []
+    batch_size = max(1, batch_size)
+    for start in range(0, len(rois), batch_size):
+        roi_objs = create_roi_objects(rois[start:start + batch_size])
+        saved = save_objects(roi_objs, conn, batch_size)
+        ids.extend(r.getId().getValue() for r in saved)
+    return ids
+
+
+def _parse_points(points: str) -> List[Tuple[float, ...]]:
+    parsed = []
+    for pt in points.split(" "):
+        # points sometimes come with a comma at the end...
+        pt = pt.rstrip(",")
+        if pt:
+            parsed.append(tuple(float(x) for x in pt.split(",")))
+    return parsed
+
+
+SHAPE_COORDS = {"Point": ("x", "y"), "Label": ("x", "y"),
+                "Rectangle": ("x", "y", "width", "height"),
+                "Mask": ("x", "y", "width", "height"),
+                "Ellipse": ("x", "y", "radius_x", "radius_y"),
+                "Line": ("x1", "y1", "x2", "y2")}
+
+
+def _shape_key(kind: str, get, style: tuple) -> tuple:
+    """
+    Comparable summary of a shape; `get` returns a field by name and
+    `style` is (fill, stroke, width, font size, marker start, marker end)
+    as create_roi_objects would write them.
+    """
+    if kind in ("Polygon", "Polyline"):
+        coords = [v for pt in _parse_points(get("points") or "")
+                  for v in pt]
+    else:
+        coords = [get(f) for f in SHAPE_COORDS.get(kind, ())]
+    coords = tuple(None if v is None else round(float(v), 3)
+                   for v in coords)
+    return (kind, coords, get("the_z"), get("the_c"), get("the_t"),
+            get("text") or None) + style
+
+
+def _ome_shape_style(shape: Shape) -> tuple:
+    font_size = getattr(shape, "font_size", None)
+    markers = tuple("Arrow" if getattr(shape, m, None) == Marker.ARROW
+                    else None for m in ("marker_start", "marker_end"))
+    return _shape_style(shape) + (
+        None if font_size is None else round(float(font_size), 3),
+        ) + markers
+
+
+def _omero_shape_style(shape, kind: str) -> tuple:
+    # importer ROIs may leave style unset; compare it with the defaults
+    def value(name):
+        method = getattr(shape, "get" + name, None)
+        val = method() if method else None
+        return val.getValue() if val is not None else None
+    fill = value("FillColor")
+    stroke = value("StrokeColor")
+    width = value("StrokeWidth")
+    font_size = value("FontSize")
+    if fill is None:
+        fill = DEFAULT_FILL_COLOR
+    if stroke is None:
+        stroke = DEFAULT_POINT_STROKE_COLOR if kind == "Point" \
+            else DEFAULT_STROKE_COLOR
+    width = float(int(width)) if width else 1.0
+    return (fill, stroke, width,
+            None if font_size is None else round(float(font_size), 3),
+            value("MarkerStart") or None, value("MarkerEnd") or None)
+
+
+def _ome_roi_key(roi: ROI) -> tuple:
+    shapes = sorted((_shape_key(type(sh).__name__,
+                                lambda f, sh=sh: getattr(sh, f, None),
+                                _ome_shape_style(sh))
+                     for sh in roi.union), key=repr)
+    return (roi.name or None, roi.description or None, tuple(shapes))
+
+
+def _omero_roi_key(roi) -> tuple:
+    def getter(shape):
+        def get(field):
+            name = {"text": "textValue"}.get(field, field)
+            name = "".join(p.capitalize() for p in name.split("_")) \
+                if "_" in name else name[0].upper() + name[1:]
+            method = getattr(shape, "get" + name, None)
+            return unwrap(method()) if method else None
+        return get
+    shapes = []
+    for sh in roi.copyShapes():
+        kind = type(sh).__name__.rstrip("I")
+        shapes.append(_shape_key(kind, getter(sh),
+                                 _omero_shape_style(sh, kind)))
+    return (unwrap(roi.getName()) or None,
+            unwrap(roi.getDescription()) or None,
+            tuple(sorted(shapes, key=repr)))
+
+
+def find_rois(image_ids: List[int], conn: BlitzGateway,
+              page_size: int = ROI_PAGE_SIZE
+              ) -> Iterator[Tuple[int, IObject]]:
+    """
+    Yield (image id, ROI with its shapes) for every ROI on the given
+    images. ROIs are paged by id, so only one page is held in memory.
+    """
+    for rois in roi_pages(conn, sorted(set(image_ids)), page_size,
+                          ctx={'omero.group': '-1'}):
+        for roi in rois:
+            yield roi.getImage().getId().getValue(), roi
 
 
-def _int_to_rgba(omero_val: int) -> Tuple[int, int, int, int]:
-    """ Helper function returning the color as an Integer in RGBA encoding """
-    if omero_val < 0:
-        omero_val = omero_val + (2**32)
-    r = omero_val >> 24
-    g = omero_val - (r << 24) >> 16
-    b = omero_val - (r << 24) - (g << 16) >> 8
-    a = omero_val - (r << 24) - (g << 16) - (b << 8)
-    # a = a / 256.0
-    return (r, g, b, a)
+def find_well_ids(plate_ids: List[int], conn: BlitzGateway) -> dict:
+    """ Ids of the wells of the given plates, by (plate id, row, column). """
+    results = query_by_ids(
+        conn,
+        "SELECT w.id, w.plate.id, w.row, w.column FROM Well w"
+        " WHERE w.plate.id IN (:ids)",
+        sorted(set(plate_ids)), projection=True)
+    return {(r[1].val, r[2].val, r[3].val): r[0].val for r in results}
 
 
-def create_rois(rois: List[ROI], imgs: List[Image], img_map: dict,
-                conn: BlitzGateway):
+def create_rois(ome: OMEIndex, img_map: dict, conn: BlitzGateway,
+                batch_size: int = SAVE_BATCH_SIZE):
+    """
+    Reconciles the ROIs the importer created on the destination images
+    with the ones in transfer.xml: importer ROIs matching one of an
+    image's ROIs (same name, description and shapes) are kept, the others
+    are deleted in a single request, and only the unmatched ROIs are
+    created, in batches.
+    """
+    imgs = [img for img in ome.ome.images if img.id in img_map]
+    # destination ROIs are only kept as (key -> ids), page by page
+    existing: Dict[int, Dict[tuple, List[int]]] = {}
+    for img_id, dest_roi in find_rois([img_map[img.id] for img in imgs],
+                                      conn):
+        key = _omero_roi_key(dest_roi)
+        existing.setdefault(img_id, {}).setdefault(key, []).append(
+            dest_roi.getId().getValue())
+    to_delete = []
+    to_create = []
     for img in imgs:
+        img_id_dest = img_map[img.id]
+        available = existing.get(img_id_dest, {})
         for roiref in img.roi_refs:
-            roi = next(filter(lambda x: x.id == roiref.id, rois))
-            shapes = create_shapes(roi)
-            img_id_dest = img_map[img.id]
-            ezomero.post_roi(conn, img_id_dest, shapes, name=roi.name,
-                             description=roi.description)
+            roi = ome.rois[roiref.id]
+            matches = available.get(_ome_roi_key(roi))
+            if matches:
+                matches.pop(0)
+                continue
+            to_create.append((img_id_dest, roi))
+        to_delete.extend(r for left in available.values() for r in left)
+    if to_delete:
+        conn.deleteObjects("Roi", to_delete, wait=True)
+    post_rois(to_create, conn, batch_size)
     return
 
 
@@ -577,119 +821,137 @@ def link_images(ome: OME, ds_map: dict, img_map: dict, conn: BlitzGateway):
     return
 
 
-def link_annotations(ome: OME, proj_map: dict, ds_map: dict, img_map: dict,
-                     ann_map: dict, scr_map: dict, pl_map: dict,
-                     conn: BlitzGateway):
-    for proj in ome.projects:
-        proj_id = proj_map[proj.id]
-        proj_obj = conn.getObject("Project", proj_id)
-        anns = ome.structured_annotations
-        for annref in proj.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(proj_obj, ann, ann_map, conn)
-    for ds in ome.datasets:
-        ds_id = ds_map[ds.id]
-        ds_obj = conn.getObject("Dataset", ds_id)
-        anns = ome.structured_annotations
-        for annref in ds.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(ds_obj, ann, ann_map, conn)
-    for img in ome.images:
-        try:
-            img_id = img_map[img.id]
-            img_obj = conn.getObject("Image", img_id)
-            anns = ome.structured_annotations
-            for annref in img.annotation_refs:
-                ann = next(filter(lambda x: x.id == annref.id, anns))
-                link_one_annotation(img_obj, ann, ann_map, conn)
-        except KeyError:
-            continue
-    for scr in ome.screens:
-        scr_id = scr_map[scr.id]
-        scr_obj = conn.getObject("Screen", scr_id)
-        anns = ome.structured_annotations
-        for annref in scr.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(scr_obj, ann, ann_map, conn)
-    for pl in ome.plates:
+LINK_TYPES = {"Project": (ProjectI, ProjectAnnotationLinkI),
+              "Dataset": (DatasetI, DatasetAnnotationLinkI),
+              "Image": (ImageI, ImageAnnotationLinkI),
+              "Screen": (ScreenI, ScreenAnnotationLinkI),
+              "Plate": (PlateI, PlateAnnotationLinkI),
+              "Well": (WellI, WellAnnotationLinkI)}
+
+# provenance XMLAnnotations are created as MapAnnotations
+ANNOTATION_TYPES = [(TagAnnotation, TagAnnotationI),
+                    (MapAnnotation, MapAnnotationI),
+                    (CommentAnnotation, CommentAnnotationI),
+                    (LongAnnotation, LongAnnotationI),
+                    (FileAnnotation, FileAnnotationI),
+                    (XMLAnnotation, MapAnnotationI)]
+
+
+def create_annotation_link(obj_type: str, obj_id: int, ann: Annotation,
+                           ann_id: int) -> Union[IObject, None]:
+    """ Unsaved link between two existing objects, built from ids only. """
+    ann_class = next((omero_class for ome_class, omero_class
+                      in ANNOTATION_TYPES if isinstance(ann, ome_class)),
+                     None)
+    if ann_class is None:
+        return None
+    parent_class, link_class = LINK_TYPES[obj_type]
+    link = link_class()
+    link.setParent(parent_class(obj_id, False))
+    link.setChild(ann_class(ann_id, False))
+    return link
+
+
+def link_annotations(ome: OMEIndex, proj_map: dict, ds_map: dict,
+                     img_map: dict, ann_map: dict, scr_map: dict, pl_map: dict,
+                     conn: BlitzGateway, batch_size: int = SAVE_BATCH_SIZE):
+    targets = []
+    for proj in ome.projects.values():
+        targets.append(("Project", proj_map[proj.id], proj.annotation_refs))
+    for ds in ome.datasets.values():
+        targets.append(("Dataset", ds_map[ds.id], ds.annotation_refs))
+    for img in ome.images.values():
+        if img.id in img_map:
+            targets.append(("Image", img_map[img.id], img.annotation_refs))
+    for scr in ome.screens.values():
+        targets.append(("Screen", scr_map[scr.id], scr.annotation_refs))
+    for pl in ome.plates.values():
+        targets.append(("Plate", pl_map[pl.id], pl.annotation_refs))
+    annotated = [pl for pl in ome.plates.values()
+                 if any(well.annotation_refs for well in pl.wells)]
+    well_ids = find_well_ids([pl_map[pl.id] for pl in annotated], conn)
+    for pl in annotated:
         pl_id = pl_map[pl.id]
-        pl_obj = conn.getObject("Plate", pl_id)
-        anns = ome.structured_annotations
-        for annref in pl.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(pl_obj, ann, ann_map, conn)
-        anns = ome.structured_annotations
         for well in pl.wells:
-            if len(well.annotation_refs) > 0:
-                row, col = well.row, well.column
-                well_id = ezomero.get_well_id(conn, pl_id, row, col)
-                well_obj = conn.getObject("Well", well_id)
-                for annref in well.annotation_refs:
-                    ann = next(filter(lambda x: x.id == annref.id, anns))
-                    link_one_annotation(well_obj, ann, ann_map, conn)
+            well_id = well_ids.get((pl_id, well.row, well.column))
+            if well.annotation_refs and well_id is not None:
+                targets.append(("Well", well_id, well.annotation_refs))
+    links = []
+    linked = set()
+    for obj_type, obj_id, annrefs in targets:
+        for annref in annrefs:
+            key = (obj_type, obj_id, annref.id)
+            if annref.id not in ann_map or key in linked:
+                continue
+            linked.add(key)
+            link = create_annotation_link(obj_type, obj_id,
+                                          ome.annotations[annref.id],
+                                          ann_map[annref.id])
+            if link is not None:
+                links.append(link)
+    save_objects(links, conn, batch_size)
     return
 
 
-def link_one_annotation(obj: IObject, ann: Annotation, ann_map: dict,
-                        conn: BlitzGateway):
-    ann_id = ann_map[ann.id]
-    if isinstance(ann, TagAnnotation):
-        ann_obj = conn.getObject("TagAnnotation", ann_id)
-    elif isinstance(ann, MapAnnotation):
-        ann_obj = conn.getObject("MapAnnotation", ann_id)
-    elif isinstance(ann, CommentAnnotation):
-        ann_obj = conn.getObject("CommentAnnotation", ann_id)
-    elif isinstance(ann, LongAnnotation):
-        ann_obj = conn.getObject("LongAnnotation", ann_id)
-    elif isinstance(ann, FileAnnotation):
-        ann_obj = conn.getObject("FileAnnotation", ann_id)
-    elif isinstance(ann, XMLAnnotation):
-        ann_obj = conn.getObject("MapAnnotation", ann_id)
-    else:
-        ann_obj = None
-    if ann_obj:
-        obj.linkAnnotation(ann_obj)
+def _rename_objects(obj_type: str, names: dict, conn: BlitzGateway,
+                    batch_size: int = SAVE_BATCH_SIZE):
+    # `names` maps destination ids to new names. Like the annotations
+    # and links of populate_omero, they are saved in the session's group,
+    # which is where the files were imported
+    objs = query_by_ids(conn,
+                        f"SELECT o FROM {obj_type} o WHERE o.id IN (:ids)",
+                        list(names))
+    for obj in objs:
+        obj.setName(rstring(names[obj.getId().getValue()]))
+    save_objects(objs, conn, batch_size)
 
 
-def rename_images(imgs: List[Image], img_map: dict, conn: BlitzGateway):
+def rename_images(imgs: List[Image], img_map: dict, conn: BlitzGateway,
+                  batch_size: int = SAVE_BATCH_SIZE):
+    names = {}
     for img in imgs:
         try:
-            img_id = img_map[img.id]
-            im_obj = conn.getObject("Image", img_id)
-            im_obj.setName(img.name)
-            im_obj.save()
+            names[img_map[img.id]] = img.name
         except KeyError:
             print(f"Image corresponding to {img.id} not found. Skipping.")
+    _rename_objects("Image", names, conn, batch_size)
     return
 
 
-def rename_plates(pls: List[Plate], pl_map: dict, conn: BlitzGateway):
+def rename_plates(pls: List[Plate], pl_map: dict, conn: BlitzGateway,
+                  batch_size: int = SAVE_BATCH_SIZE):
+    names = {}
     for pl in pls:
         try:
-            pl_id = pl_map[pl.id]
-            pl_obj = conn.getObject("Plate", pl_id)
-            pl_obj.setName(pl.name)
-            pl_obj.save()
+            names[pl_map[pl.id]] = pl.name
         except KeyError:
             print(f"Plate corresponding to {pl.id} not found. Skipping.")
+    _rename_objects("Plate", names, conn, batch_size)
     return
 
 
 def populate_omero(ome: OME, img_map: dict, conn: BlitzGateway, hash: str,
                    folder: str, metadata: List[str], merge: bool,
-                   figure: bool):
-    plate_map, ome = create_plate_map(ome, img_map, conn)
-    rename_images(ome.images, img_map, conn)
-    rename_plates(ome.plates, plate_map, conn)
-    proj_map = create_or_set_projects(ome.projects, conn, merge)
-    ds_map = create_or_set_datasets(ome.datasets, ome.projects, conn, merge)
-    screen_map = create_or_set_screens(ome.screens, conn, merge)
+                   figure: bool, batch_size: int = SAVE_BATCH_SIZE,
+                   paths: Optional[ServerPathIndex] = None):
+    if paths is None:
+        paths = ServerPathIndex(ome.structured_annotations)
+    plate_map, ome = create_plate_map(ome, img_map, conn, paths)
+    index = OMEIndex(ome)
+    rename_images(ome.images, img_map, conn, batch_size)
+    rename_plates(ome.plates, plate_map, conn, batch_size)
+    catalog = ContainerCatalog(conn) if merge else None
+    proj_map = create_or_set_projects(ome.projects, conn, merge, catalog)
+    ds_map = create_or_set_datasets(ome.datasets, ome.projects, conn, merge,
+                                    catalog)
+    screen_map = create_or_set_screens(ome.screens, conn, merge, catalog)
     ann_map = create_annotations(ome.structured_annotations, conn,
-                                 hash, folder, figure, img_map, metadata)
-    create_rois(ome.rois, ome.images, img_map, conn)
+                                 hash, folder, figure, img_map, metadata,
+                                 batch_size, paths)
+    create_rois(index, img_map, conn, batch_size)
     link_plates(ome, screen_map, plate_map, conn)
     link_datasets(ome, proj_map, ds_map, conn)
     link_images(ome, ds_map, img_map, conn)
-    link_annotations(ome, proj_map, ds_map, img_map, ann_map,
-                     screen_map, plate_map, conn)
+    link_annotations(index, proj_map, ds_map, img_map, ann_map,
+                     screen_map, plate_map, conn, batch_size)
     return
@@ -19,16 +19,21 @@ from ome_types.model import Point, Line, Rectangle, Ellipse, Polygon
 from ome_types.model import Polyline, Label, Shape
 from ome_types.model.map import M
 from omero.sys import Parameters
-from omero.gateway import BlitzGateway
+from omero.rtypes import unwrap
+from omero.gateway import BlitzGateway, AnnotationWrapper
 from omero.model import TagAnnotationI, MapAnnotationI, FileAnnotationI
-from omero.model import CommentAnnotationI, LongAnnotationI, Fileset
+from omero.model import CommentAnnotationI, LongAnnotationI
 from omero.model import PointI, LineI, RectangleI, EllipseI, PolygonI
-from omero.model import PolylineI, LabelI, ImageI, RoiI, IObject
-from omero.model import DatasetI, ProjectI, ScreenI, PlateI, WellI, Annotation
+from omero.model import PolylineI, LabelI, RoiI
+from omero.model import ScreenI, PlateI, WellI, Annotation
 from omero.cli import CLI
-from typing import Tuple, List, Optional, Union, Any, Dict, TextIO
+from typing import Tuple, List, Optional, Union, Any, Dict, TextIO, Iterator
+from typing import Set
 from subprocess import PIPE, DEVNULL
 from generate_omero_objects import get_server_path
+from ome_index import OMEIndex, ServerPathIndex
+from omero_queries import query_by_ids, roi_pages, ROI_PAGE_SIZE
+from download_files import FileDownloader
 import xml.etree.cElementTree as ETree
 from os import PathLike
 import pkg_resources
@@ -36,6 +41,7 @@ import ezomero
 import os
 import csv
 import base64
+import hashlib
 from uuid import uuid4
 from datetime import datetime
 from pathlib import Path
@@ -68,22 +74,271 @@ def create_dataset_and_ref(**kwargs) -> Tuple[Dataset, DatasetRef]:
     return ds, ds_ref
 
 
-def create_pixels(obj: ImageI) -> Pixels:
-    # we're assuming a single Pixels object per image
-    pix_obj = obj.getPrimaryPixels()
+def create_pixels(img_id: int, pix: Dict[str, Any]) -> Pixels:
     pixels = Pixels(
-        id=obj.getId(),
-        dimension_order=pix_obj.getDimensionOrder().getValue(),
-        size_c=pix_obj.getSizeC(),
-        size_t=pix_obj.getSizeT(),
-        size_x=pix_obj.getSizeX(),
-        size_y=pix_obj.getSizeY(),
-        size_z=pix_obj.getSizeZ(),
-        type=pix_obj.getPixelsType().getValue(),
+        id=img_id,
+        dimension_order=pix['dimension_order'],
+        size_c=pix['size_c'],
+        size_t=pix['size_t'],
+        size_x=pix['size_x'],
+        size_y=pix['size_y'],
+        size_z=pix['size_z'],
+        type=pix['type'],
         metadata_only=True)
     return pixels
 
 
+def _projection(conn: BlitzGateway, query: str, ids: List[int]
+                ) -> List[List[Any]]:
+    # runs `query` once per batch of ids, bound to the `:ids` parameter
+    return [[unwrap(col) for col in row]
+            for row in query_by_ids(conn, query, ids, projection=True)]
+
+
+def load_images(conn: BlitzGateway, img_ids: List[int]) -> Dict[int, dict]:
+    """
+    Load name, description, fileset and primary Pixels of many images
+    with batched projections instead of one getObject call per image.
+    """
+    images: Dict[int, dict] = {}
+    rows = _projection(
+        conn,
+        "SELECT i.id, i.name, i.description, fs.id FROM Image i"
+        " LEFT OUTER JOIN i.fileset fs WHERE i.id IN (:ids)",
+        img_ids)
+    for img_id, name, desc, fs_id in rows:
+        images[img_id] = {'id': img_id, 'name': name, 'description': desc,
+                          'fileset': fs_id, 'pixels': None}
+    rows = _projection(
+        conn,
+        "SELECT p.image.id, p.dimensionOrder.value, p.sizeC, p.sizeT,"
+        " p.sizeX, p.sizeY, p.sizeZ, p.pixelsType.value FROM Pixels p"
+        " WHERE p.image.id IN (:ids) ORDER BY p.id",
+        img_ids)
+    for img_id, dim_order, size_c, size_t, size_x, size_y, size_z, \
+            pix_type in rows:
+        # we're assuming a single Pixels object per image
+        if images[img_id]['pixels'] is not None:
+            continue
+        images[img_id]['pixels'] = {
+            'dimension_order': dim_order, 'size_c': size_c,
+            'size_t': size_t, 'size_x': size_x, 'size_y': size_y,
+            'size_z': size_z, 'type': pix_type}
+    return images
+
+
+def load_filesets(conn: BlitzGateway, fs_ids: List[int]
+                  ) -> Dict[int, List[int]]:
+    filesets: Dict[int, List[int]] = {fs_id: [] for fs_id in fs_ids}
+    rows = _projection(
+        conn,
+        "SELECT i.fileset.id, i.id FROM Image i"
+        " WHERE i.fileset.id IN (:ids) ORDER BY i.id",
+        fs_ids)
+    for fs_id, img_id in rows:
+        filesets[fs_id].append(img_id)
+    return filesets
+
+
+class FilesetCache:
+    """
+    Fileset id -> member image ids (and original file paths) for everything
+    seen during a pack, shared by metadata traversal, path annotations and
+    downloads so that each fileset is listed and downloaded only once.
+    """
+
+    def __init__(self):
+        self.filesets: Dict[int, List[int]] = {}
+        self.image_filesets: Dict[int, Optional[int]] = {}
+        self.filepaths: Dict[int, List[str]] = {}
+        self.common_roots: Dict[int, Path] = {}
+        self.downloaded: Set[int] = set()
+
+    def add_images(self, images: Dict[int, dict]):
+        for img_id, img in images.items():
+            self.image_filesets[img_id] = img['fileset']
+
+    def load_images(self, conn: BlitzGateway, img_ids: List[int]):
+        missing = [i for i in img_ids if i not in self.image_filesets]
+        rows = _projection(
+            conn,
+            "SELECT i.id, fs.id FROM Image i LEFT OUTER JOIN i.fileset fs"
+            " WHERE i.id IN (:ids)",
+            missing)
+        for img_id, fs_id in rows:
+            self.image_filesets[img_id] = fs_id
+
+    def load(self, conn: BlitzGateway, fs_ids: List[int]):
+        missing = [i for i in set(fs_ids) if i not in self.filesets]
+        for fs_id, members in load_filesets(conn, missing).items():
+            self.filesets[fs_id] = members
+            for img_id in members:
+                self.image_filesets[img_id] = fs_id
+        for fs_id, fpaths in load_filepaths(conn, missing).items():
+            self.filepaths[fs_id] = fpaths
+            if len(fpaths) > 1:
+                self.common_roots[fs_id] = find_common_root(fpaths)
+
+    def fileset_of(self, conn: BlitzGateway, img_id: int) -> Optional[int]:
+        self.load_images(conn, [img_id])
+        return self.image_filesets.get(img_id)
+
+    def members(self, conn: BlitzGateway, fs_id: int) -> List[int]:
+        self.load(conn, [fs_id])
+        return self.filesets[fs_id]
+
+    def get_filepaths(self, conn: BlitzGateway, img_id: int) -> List[str]:
+        fs_id = self.fileset_of(conn, img_id)
+        if fs_id is None:
+            return []
+        self.load(conn, [fs_id])
+        return self.filepaths[fs_id]
+
+    def get_common_root(self, conn: BlitzGateway, img_id: int) -> Path:
+        fs_id = self.fileset_of(conn, img_id)
+        self.load(conn, [fs_id])
+        return self.common_roots[fs_id]
+
+
+def load_filepaths(conn: BlitzGateway, fs_ids: List[int]
+                   ) -> Dict[int, List[str]]:
+    # same paths as ezomero.get_original_filepaths, for many filesets at once
+    filepaths: Dict[int, List[str]] = {fs_id: [] for fs_id in fs_ids}
+    rows = _projection(
+        conn,
+        "SELECT fe.fileset.id, o.path||o.name FROM FilesetEntry fe"
+        " JOIN fe.originalFile o WHERE fe.fileset.id IN (:ids)"
+        " ORDER BY fe.id",
+        fs_ids)
+    for fs_id, fpath in rows:
+        filepaths[fs_id].append(fpath)
+    return filepaths
+
+
+def find_common_root(fpaths: List[str]) -> Path:
+    allpaths = []
+    for f in fpaths:
+        allpaths.append(Path(f).parts)
+    return Path(*os.path.commonprefix(allpaths))
+
+
+def load_container_graph(conn: BlitzGateway, datatype: str,
+                         ids: List[int],
+                         filesets: Optional[FilesetCache] = None
+                         ) -> Dict[str, Any]:
+    """
+    Load the Project -> Dataset -> Image -> Pixels hierarchy under the
+    given objects with a handful of batched projections. Plates and
+    single images only get their images (and filesets) loaded.
+    """
+    if filesets is None:
+        filesets = FilesetCache()
+    graph: Dict[str, Any] = {'projects': {}, 'datasets': {},
+                             'images': {}, 'filesets': filesets}
+    if datatype == 'Image':
+        img_ids = list(ids)
+    elif datatype == 'Plate':
+        rows = _projection(
+            conn,
+            "SELECT ws.image.id FROM WellSample ws"
+            " WHERE ws.well.plate.id IN (:ids)",
+            ids)
+        img_ids = list(set(r[0] for r in rows))
+    else:
+        img_ids = _load_datasets(conn, datatype, ids, graph)
+    graph['images'] = load_images(conn, img_ids)
+    filesets.add_images(graph['images'])
+    fs_ids = set(i['fileset'] for i in graph['images'].values())
+    fs_ids.discard(None)
+    filesets.load(conn, list(fs_ids))
+    prefetch_annotations(conn, graph, 'Project', list(graph['projects']))
+    prefetch_annotations(conn, graph, 'Dataset', list(graph['datasets']))
+    prefetch_annotations(conn, graph, 'Image', img_ids)
+    if datatype == 'Plate':
+        prefetch_annotations(conn, graph, 'Plate', list(ids))
+        rows = _projection(
+            conn,
+            "SELECT w.id FROM Well w WHERE w.plate.id IN (:ids)",
+            ids)
+        prefetch_annotations(conn, graph, 'Well', [r[0] for r in rows])
+    return graph
+
+
+def _load_datasets(conn: BlitzGateway, datatype: str, ids: List[int],
+                   graph: Dict[str, Any]) -> List[int]:
+    if datatype == 'Project':
+        rows = _projection(
+            conn,
+            "SELECT p.id, p.name, p.description FROM Project p"
+            " WHERE p.id IN (:ids)",
+            ids)
+        for pj_id, name, desc in rows:
+            graph['projects'][pj_id] = {'id': pj_id, 'name': name,
+                                        'description': desc, 'datasets': []}
+        rows = _projection(
+            conn,
+            "SELECT l.parent.id, d.id, d.name, d.description"
+            " FROM ProjectDatasetLink l JOIN l.child d"
+            " WHERE l.parent.id IN (:ids) ORDER BY d.id",
+            ids)
+        for pj_id, ds_id, name, desc in rows:
+            graph['projects'][pj_id]['datasets'].append(ds_id)
+            graph['datasets'][ds_id] = {'id': ds_id, 'name': name,
+                                        'description': desc, 'images': []}
+    else:
+        rows = _projection(
+            conn,
+            "SELECT d.id, d.name, d.description FROM Dataset d"
+            " WHERE d.id IN (:ids)",
+            ids)
+        for ds_id, name, desc in rows:
+            graph['datasets'][ds_id] = {'id': ds_id, 'name': name,
+                                        'description': desc, 'images': []}
+    rows = _projection(
+        conn,
+        "SELECT l.parent.id, l.child.id FROM DatasetImageLink l"
+        " WHERE l.parent.id IN (:ids) ORDER BY l.child.id",
+        list(graph['datasets']))
+    img_ids = []
+    for ds_id, img_id in rows:
+        graph['datasets'][ds_id]['images'].append(img_id)
+        img_ids.append(img_id)
+    return list(set(img_ids))
+
+
+def load_annotations(conn: BlitzGateway, otype: str, ids: List[int]
+                     ) -> Dict[int, List[AnnotationWrapper]]:
+    """
+    Load the annotations linked to many objects of one type with one query
+    per batch of ids, rather than one listAnnotations() call per object.
+    """
+    anns: Dict[int, List[AnnotationWrapper]] = {i: [] for i in ids}
+    links = query_by_ids(
+        conn,
+        f"SELECT l FROM {otype}AnnotationLink l JOIN FETCH l.child a"
+        " LEFT OUTER JOIN FETCH a.file WHERE l.parent.id IN (:ids)"
+        " ORDER BY l.id", ids)
+    for link in links:
+        parent_id = link.getParent().getId().getValue()
+        anns[parent_id].append(
+            AnnotationWrapper._wrap(conn, link.getChild(), link=link))
+    return anns
+
+
+def prefetch_annotations(conn: BlitzGateway, graph: dict, otype: str,
+                         ids: List[int]):
+    cached = graph.setdefault('annotations', {}).setdefault(otype, {})
+    missing = [i for i in ids if i not in cached]
+    if missing:
+        cached.update(load_annotations(conn, otype, missing))
+
+
+def get_annotations(conn: BlitzGateway, graph: dict, otype: str, oid: int
+                    ) -> List[AnnotationWrapper]:
+    prefetch_annotations(conn, graph, otype, [oid])
+    return graph['annotations'][otype][oid]
+
+
 def create_image_and_ref(**kwargs) -> Tuple[Image, ImageRef]:
     img = Image(**kwargs)
     img_ref = ImageRef(id=img.id)
@@ -363,6 +618,7 @@ def create_filepath_annotations(id: str, conn: BlitzGateway,
                                 plate_path: Optional[str] = None,
                                 ds: Optional[str] = None,
                                 proj: Optional[str] = None,
+                                filesets: Optional[FilesetCache] = None,
                                 ) -> Tuple[List[XMLAnnotation],
                                            List[AnnotationRef]]:
     global ann_count
@@ -376,18 +632,19 @@ def create_filepath_annotations(id: str, conn: BlitzGateway,
     if not proj:
         proj = ""
     if fp_type == "Image":
-        fpaths = ezomero.get_original_filepaths(conn, clean_id)
+        if filesets is not None:
+            fpaths = filesets.get_filepaths(conn, clean_id)
+        else:
+            fpaths = ezomero.get_original_filepaths(conn, clean_id)
         if len(fpaths) > 1:
             if not simple:
-                allpaths = []
-                for f in fpaths:
-                    f = Path(f)
-                    allpaths.append(f.parts)
-                common_root = Path(*os.path.commonprefix(allpaths))
+                if filesets is not None:
+                    root = filesets.get_common_root(conn, clean_id)
+                else:
+                    root = find_common_root(fpaths)
             else:
-                common_root = "./"
-                common_root = Path(common_root) / proj / ds
-            path = os.path.join(common_root, 'mock_folder')
+                root = Path("./") / proj / ds
+            path = os.path.join(root, 'mock_folder')
             xml = create_path_xml(path)
             an, anref = create_xml_and_ref(id=ann_count,
                                            namespace=ns,
@@ -471,21 +728,36 @@ def create_figure_annotations(id: str) -> Tuple[XMLAnnotation,
     return (an, anref)
 
 
+def create_provenance_context(conn: BlitzGateway, hostname: str
+                              ) -> Dict[str, Any]:
+    """
+    Provenance values shared by every image and plate of a pack; these
+    only need to be looked up once per pack session.
+    """
+    software = "omero-cli-transfer"
+    return {
+        'software': software,
+        'version': pkg_resources.get_distribution(software).version,
+        'packing_timestamp': datetime.now().strftime("%d/%m/%Y, %H:%M:%S"),
+        'origin_hostname': hostname,
+        'original_user': conn.getUser().getName(),
+        'original_group': conn.getGroupFromContext().getName(),
+        'database_id': conn.getConfigService().getDatabaseUuid(),
+    }
+
+
 def create_provenance_metadata(conn: BlitzGateway, img_id: int,
                                hostname: str,
-                               metadata: Union[List[str], None], plate: bool
+                               metadata: Union[List[str], None], plate: bool,
+                               provenance: Optional[Dict[str, Any]] = None
                                ) -> Union[Tuple[MapAnnotation, AnnotationRef],
                                           Tuple[None, None]]:
     global ann_count
     if not metadata:
         return None, None
-    software = "omero-cli-transfer"
-    version = pkg_resources.get_distribution(software).version
-    date_time = datetime.now().strftime("%d/%m/%Y, %H:%M:%S")
+    if provenance is None:
+        provenance = create_provenance_context(conn, hostname)
     ns = 'openmicroscopy.org/cli/transfer'
-    curr_user = conn.getUser().getName()
-    curr_group = conn.getGroupFromContext().getName()
-    db_id = conn.getConfigService().getDatabaseUuid()
 
     md_dict: Dict[str, Any] = {}
     if plate:
@@ -495,21 +767,21 @@ def create_provenance_metadata(conn: BlitzGateway, img_id: int,
         if "img_id" in metadata:
             md_dict['origin_image_id'] = img_id
     if "timestamp" in metadata:
-        md_dict['packing_timestamp'] = date_time
+        md_dict['packing_timestamp'] = provenance['packing_timestamp']
     if "software" in metadata:
-        md_dict['software'] = software
+        md_dict['software'] = provenance['software']
     if "version" in metadata:
-        md_dict['version'] = version
+        md_dict['version'] = provenance['version']
     if "hostname" in metadata:
-        md_dict['origin_hostname'] = hostname
+        md_dict['origin_hostname'] = provenance['origin_hostname']
     if "md5" in metadata:
         md_dict['md5'] = "TBC"
     if "orig_user" in metadata:
-        md_dict['original_user'] = curr_user
+        md_dict['original_user'] = provenance['original_user']
     if "orig_group" in metadata:
-        md_dict['original_group'] = curr_group
+        md_dict['original_group'] = provenance['original_group']
     if "db_id" in metadata:
-        md_dict['database_id'] = db_id
+        md_dict['database_id'] = provenance['database_id']
     xml = create_metadata_xml(md_dict)
     an, anref = create_xml_and_ref(id=ann_count,
                                    namespace=ns,
@@ -521,7 +793,6 @@ def create_provenance_metadata(conn: BlitzGateway, img_id: int,
 def create_objects(folder, filelist):
     img_files = []
     cli = CLI()
-    cli.loadplugins()
     par_folder = Path(folder).parent
     if not filelist:
         for path, subdirs, files in os.walk(folder):
@@ -669,6 +940,24 @@ def create_path_xml(target):
     return ETree.tostring(base, encoding='unicode')
 
 
+def create_checksums_xml(files: List[Dict[str, Any]]) -> str:
+    base = ETree.Element("CLITransferChecksums", attrib={
+        "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+        "xsi:schemaLocation":
+        "https://raw.githubusercontent.com/ome/omero-cli-transfer/"
+        "main/schemas/checksums.xsd"})
+    for f in files:
+        attrib = {"Path": f["path"], "Size": str(f["size"])}
+        if f.get("sha1"):
+            attrib["SHA1"] = f["sha1"]
+        if f.get("md5"):
+            attrib["MD5"] = f["md5"]
+        if f.get("failed"):
+            attrib["Failed"] = "true"
+        ETree.SubElement(base, "File", attrib=attrib)
+    return ETree.tostring(base, encoding='unicode')
+
+
 def create_prepare_metadata(ann_id):
     software = "omero-cli-transfer"
     version = pkg_resources.get_distribution(software).version
@@ -711,8 +1000,24 @@ def create_empty_pixels(image, id):
     return pixels
 
 
-def populate_roi(obj: RoiI, roi_obj: IObject, ome: OME, conn: BlitzGateway
-                 ) -> Union[ROIRef, None]:
+def iter_rois(conn: BlitzGateway, img_ids: List[int],
+              page_size: int = ROI_PAGE_SIZE
+              ) -> Iterator[Tuple[int, RoiI, List[AnnotationWrapper]]]:
+    """
+    Yield (image id, ROI, ROI annotations) for every ROI on the given images.
+    ROIs are paged by id, and each page is loaded with its shapes and
+    annotations in bulk, so only one page is held in memory at a time.
+    """
+    for rois in roi_pages(conn, img_ids, page_size):
+        anns = load_annotations(conn, 'Roi',
+                                [roi.getId().getValue() for roi in rois])
+        for roi in rois:
+            yield (roi.getImage().getId().getValue(), roi,
+                   anns[roi.getId().getValue()])
+
+
+def populate_roi(obj: RoiI, anns: List[AnnotationWrapper], ome: OMEIndex,
+                 conn: BlitzGateway) -> Union[ROIRef, None]:
     id = obj.getId().getValue()
     name = obj.getName()
     if name is not None:
@@ -725,159 +1030,174 @@ def populate_roi(obj: RoiI, roi_obj: IObject, ome: OME, conn: BlitzGateway
         return None
     roi, roi_ref = create_roi_and_ref(id=id, name=name, description=desc,
                                       union=shapes)
-    for ann in roi_obj.listAnnotations():
+    for ann in anns:
         add_annotation(roi, ann, ome, conn)
-    if roi not in ome.rois:
-        ome.rois.append(roi)
+    ome.add_roi(roi)
     return roi_ref
 
 
-def populate_image(obj: ImageI, ome: OME, conn: BlitzGateway, hostname: str,
-                   metadata: List[str], simple: bool,
-                   fset: Union[None, Fileset] = None,
+def populate_rois(ome: OMEIndex, conn: BlitzGateway):
+    # ROIs are exported for all packed images at once, after traversal
+    img_ids = [int(i.split(":")[-1]) for i in ome.images]
+    for img_id, roi, anns in iter_rois(conn, img_ids):
+        roi_ref = populate_roi(roi, anns, ome, conn)
+        if not roi_ref:
+            continue
+        ome.images[f"Image:{img_id}"].roi_refs.append(roi_ref)
+
+
+def populate_image(img_data: dict, ome: OMEIndex, conn: BlitzGateway,
+                   hostname: str, metadata: List[str], simple: bool,
+                   fset: Optional[int] = None,
                    ds: Optional[str] = None, proj: Optional[str] = None,
+                   graph: Optional[dict] = None,
                    ) -> ImageRef:
-    id = obj.getId()
-    name = obj.getName()
-    desc = obj.getDescription()
+    id = img_data['id']
+    name = img_data['name']
+    desc = img_data['description']
     img_id = f"Image:{str(id)}"
-    if img_id in [i.id for i in ome.images]:
+    if img_id in ome.images:
         img_ref = ImageRef(id=img_id)
         return img_ref
-    pix = create_pixels(obj)
+    pix = create_pixels(id, img_data['pixels'])
     img, img_ref = create_image_and_ref(id=id, name=name,
                                         description=desc, pixels=pix)
-    for ann in obj.listAnnotations():
+    if graph is None:
+        graph = {'images': {}, 'filesets': FilesetCache()}
+    for ann in get_annotations(conn, graph, 'Image', id):
         add_annotation(img, ann, ome, conn)
-    kv, ref = create_provenance_metadata(conn, id, hostname, metadata, False)
+    kv, ref = create_provenance_metadata(conn, id, hostname, metadata, False,
+                                         graph.get('provenance'))
     if kv:
-        kv_id = f"Annotation:{str(kv.id)}"
-        if kv_id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(kv)
+        ome.add_annotation(kv)
         if ref:
             img.annotation_refs.append(ref)
-    filepath_anns, refs = create_filepath_annotations(img_id, conn,
-                                                      simple, ds=ds,
-                                                      proj=proj)
+    filepath_anns, refs = create_filepath_annotations(
+                                img_id, conn, simple, ds=ds, proj=proj,
+                                filesets=graph['filesets'])
     for i in range(len(filepath_anns)):
-        ome.structured_annotations.append(filepath_anns[i])
+        ome.add_annotation(filepath_anns[i])
         img.annotation_refs.append(refs[i])
-    roi_service = conn.getRoiService()
-    rois = roi_service.findByImage(id, None).rois
-    for roi in rois:
-        roi_obj = conn.getObject('Roi', roi.getId().getValue())
-        roi_ref = populate_roi(roi, roi_obj, ome, conn)
-        if not roi_ref:
-            continue
-        img.roi_ref.append(roi_ref)
-    img_id = f"Image:{str(img.id)}"
-    if img_id not in [i.id for i in ome.datasets]:
-        ome.images.append(img)
-    if not fset:
-        fset = obj.getFileset()
-    if fset:
-        for fs_image in fset.copyImages():
-            fs_img_id = f"Image:{str(fs_image.getId())}"
-            if fs_img_id not in [i.id for i in ome.images]:
-                populate_image(fs_image, ome, conn, hostname, metadata,
-                               simple, fset)
+    ome.add_image(img)
+    if fset is None and img_data['fileset'] is not None:
+        # only the first image of a fileset walks its siblings
+        fset = img_data['fileset']
+        members = graph['filesets'].members(conn, fset)
+        missing = [i for i in members if i not in graph['images']]
+        if missing:
+            graph['images'].update(load_images(conn, missing))
+            prefetch_annotations(conn, graph, 'Image', missing)
+        for fs_image in members:
+            fs_img_id = f"Image:{str(fs_image)}"
+            if fs_img_id not in ome.images:
+                populate_image(graph['images'][fs_image], ome, conn,
+                               hostname, metadata, simple, fset,
+                               graph=graph)
     return img_ref
 
 
-def populate_dataset(obj: DatasetI, ome: OME, conn: BlitzGateway,
+def populate_dataset(ds_data: dict, ome: OMEIndex, conn: BlitzGateway,
                      hostname: str, metadata: List[str], simple: bool,
-                     proj: Optional[str] = None,
+                     graph: dict, proj: Optional[str] = None,
                      ) -> DatasetRef:
-    id = obj.getId()
-    name = obj.getName()
-    desc = obj.getDescription()
+    id = ds_data['id']
+    name = ds_data['name']
+    desc = ds_data['description']
     ds, ds_ref = create_dataset_and_ref(id=id, name=name,
                                         description=desc)
-    for ann in obj.listAnnotations():
+    for ann in get_annotations(conn, graph, 'Dataset', id):
         add_annotation(ds, ann, ome, conn)
-    for img in obj.listChildren():
-        img_obj = conn.getObject('Image', img.getId())
-        img_ref = populate_image(img_obj, ome, conn, hostname, metadata,
-                                 simple, ds=str(id) + "_" + name,
-                                 proj=proj)
+    for img_id in ds_data['images']:
+        img_ref = populate_image(graph['images'][img_id], ome, conn,
+                                 hostname, metadata, simple,
+                                 ds=str(id) + "_" + name, proj=proj,
+                                 graph=graph)
         ds.image_refs.append(img_ref)
-    ds_id = f"Dataset:{str(ds.id)}"
-    if ds_id not in [i.id for i in ome.datasets]:
-        ome.datasets.append(ds)
+    ome.add_dataset(ds)
     return ds_ref
 
 
-def populate_project(obj: ProjectI, ome: OME, conn: BlitzGateway,
-                     hostname: str, metadata: List[str], simple: bool):
-    id = obj.getId()
-    name = obj.getName()
-    desc = obj.getDescription()
+def populate_project(pj_data: dict, ome: OMEIndex, conn: BlitzGateway,
+                     hostname: str, metadata: List[str], simple: bool,
+                     graph: dict):
+    id = pj_data['id']
+    name = pj_data['name']
+    desc = pj_data['description']
     proj, _ = create_proj_and_ref(id=id, name=name, description=desc)
-    for ann in obj.listAnnotations():
+    for ann in get_annotations(conn, graph, 'Project', id):
         add_annotation(proj, ann, ome, conn)
 
-    for ds in obj.listChildren():
-        ds_obj = conn.getObject('Dataset', ds.getId())
-        ds_ref = populate_dataset(ds_obj, ome, conn, hostname, metadata,
-                                  simple, proj=str(id) + "_" + name)
+    for ds_id in pj_data['datasets']:
+        ds_ref = populate_dataset(graph['datasets'][ds_id], ome, conn,
+                                  hostname, metadata, simple, graph,
+                                  proj=str(id) + "_" + name)
 
         proj.dataset_refs.append(ds_ref)
-    ome.projects.append(proj)
+    ome.add_project(proj)
 
 
-def populate_screen(obj: ScreenI, ome: OME, conn: BlitzGateway,
-                    hostname: str, metadata: List[str]):
+def populate_screen(obj: ScreenI, ome: OMEIndex, conn: BlitzGateway,
+                    hostname: str, metadata: List[str],
+                    filesets: Optional[FilesetCache] = None,
+                    provenance: Optional[Dict[str, Any]] = None):
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     scr = create_screen(id=id, name=name, description=desc)
     for ann in obj.listAnnotations():
         add_annotation(scr, ann, ome, conn)
-    for pl in obj.listChildren():
+    plates = list(obj.listChildren())
+    graph = load_container_graph(conn, 'Plate', [p.getId() for p in plates],
+                                 filesets)
+    graph['provenance'] = provenance
+    for pl in plates:
         pl_obj = conn.getObject('Plate', pl.getId())
-        pl_ref = populate_plate(pl_obj, ome, conn, hostname, metadata)
+        pl_ref = populate_plate(pl_obj, ome, conn, hostname, metadata,
+                                graph)
         scr.plate_refs.append(pl_ref)
-    ome.screens.append(scr)
+    ome.add_screen(scr)
 
 
-def populate_plate(obj: PlateI, ome: OME, conn: BlitzGateway,
-                   hostname: str, metadata: List[str]) -> PlateRef:
+def populate_plate(obj: PlateI, ome: OMEIndex, conn: BlitzGateway,
+                   hostname: str, metadata: List[str],
+                   graph: Optional[dict] = None) -> PlateRef:
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     print(f"populating plate {id}")
+    if graph is None:
+        graph = load_container_graph(conn, 'Plate', [id])
     pl, pl_ref = create_plate_and_ref(id=id, name=name, description=desc)
-    for ann in obj.listAnnotations():
+    for ann in get_annotations(conn, graph, 'Plate', id):
         add_annotation(pl, ann, ome, conn)
-    kv, ref = create_provenance_metadata(conn, id, hostname, metadata, True)
+    kv, ref = create_provenance_metadata(conn, id, hostname, metadata, True,
+                                         graph.get('provenance'))
     if kv:
-        kv_id = f"Annotation:{str(kv.id)}"
-        if kv_id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(kv)
+        ome.add_annotation(kv)
         if ref:
             pl.annotation_refs.append(ref)
     for well in obj.listChildren():
         well_obj = conn.getObject('Well', well.getId())
-        well_ref = populate_well(well_obj, ome, conn, hostname, metadata)
+        well_ref = populate_well(well_obj, ome, conn, hostname, metadata,
+                                 graph)
         pl.wells.append(well_ref)
 
     # this will need some changing to tackle XMLs
-    last_image_anns = ome.images[-1].annotation_refs
-    plate_path = get_server_path(last_image_anns, ome.structured_annotations)
+    last_image_anns = ome.ome.images[-1].annotation_refs
+    plate_path = get_server_path(last_image_anns,
+                                 ome.get_annotations(last_image_anns))
     filepath_anns, refs = create_filepath_annotations(pl.id, conn,
                                                       simple=False,
                                                       plate_path=plate_path)
     for i in range(len(filepath_anns)):
-        ome.structured_annotations.append(filepath_anns[i])
+        ome.add_annotation(filepath_anns[i])
         pl.annotation_refs.append(refs[i])
-    pl_id = f"Plate:{str(pl.id)}"
-    if pl_id not in [i.id for i in ome.plates]:
-        ome.plates.append(pl)
+    ome.add_plate(pl)
     return pl_ref
 
 
-def populate_well(obj: WellI, ome: OME, conn: BlitzGateway,
-                  hostname: str, metadata: List[str]) -> Well:
+def populate_well(obj: WellI, ome: OMEIndex, conn: BlitzGateway,
+                  hostname: str, metadata: List[str], graph: dict) -> Well:
     id = obj.getId()
     column = obj.getColumn()
     row = obj.getRow()
@@ -886,26 +1206,28 @@ def populate_well(obj: WellI, ome: OME, conn: BlitzGateway,
     for index in range(obj.countWellSample()):
         ws_obj = obj.getWellSample(index)
         ws_id = ws_obj.getId()
-        ws_img = ws_obj.getImage()
-        ws_img_ref = populate_image(ws_img, ome, conn, hostname, metadata,
-                                    simple=False)
+        ws_img_id = ws_obj.getImage().getId()
+        if ws_img_id not in graph['images']:
+            graph['images'].update(load_images(conn, [ws_img_id]))
+        ws_img_ref = populate_image(graph['images'][ws_img_id], ome, conn,
+                                    hostname, metadata, simple=False,
+                                    graph=graph)
         ws_index = int(ws_img_ref.id.split(":")[-1])
         ws = WellSample(id=ws_id, index=ws_index, image_ref=ws_img_ref)
         samples.append(ws)
     well = Well(id=id, row=row, column=column, well_samples=samples)
-    for ann in obj.listAnnotations():
+    for ann in get_annotations(conn, graph, 'Well', id):
         add_annotation(well, ann, ome, conn)
     return well
 
 
 def add_annotation(obj: Union[Project, Dataset, Image, Plate, Screen,
                               Well, ROI],
-                   ann: Annotation, ome: OME, conn: BlitzGateway):
+                   ann: Annotation, ome: OMEIndex, conn: BlitzGateway):
     if ann.OMERO_TYPE == TagAnnotationI:
         tag, ref = create_tag_and_ref(id=ann.getId(),
                                       value=ann.getTextValue())
-        if tag.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(tag)
+        ome.add_annotation(tag)
         obj.annotation_ref.append(ref)
 
     elif ann.OMERO_TYPE == MapAnnotationI:
@@ -919,26 +1241,27 @@ def add_annotation(obj: Union[Project, Dataset, Image, Plate, Screen,
                                     namespace=ann.getNs(),
                                     value=Map(
                                     ms=mmap))
-        if kv.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(kv)
+        ome.add_annotation(kv)
         obj.annotation_ref.append(ref)
 
     elif ann.OMERO_TYPE == CommentAnnotationI:
         comm, ref = create_comm_and_ref(id=ann.getId(),
                                         value=ann.getTextValue())
-        if comm.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(comm)
+        ome.add_annotation(comm)
         obj.annotation_ref.append(ref)
 
     elif ann.OMERO_TYPE == LongAnnotationI:
         long, ref = create_long_and_ref(id=ann.getId(),
                                         namespace=ann.getNs(),
                                         value=ann.getValue())
-        if long.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(long)
+        ome.add_annotation(long)
         obj.annotation_ref.append(ref)
 
     elif ann.OMERO_TYPE == FileAnnotationI:
+        f_id = f"Annotation:{ann.getId()}"
+        if f_id in ome.annotations:
+            obj.annotation_ref.append(AnnotationRef(id=f_id))
+            return
         contents = ann.getFile().getPath().encode()
         b64 = base64.b64encode(contents)
         length = len(b64)
@@ -959,52 +1282,128 @@ def add_annotation(obj: Union[Project, Dataset, Image, Plate, Screen,
                                 simple=False,
                                 filename=ann.getFile().getName())
         for i in range(len(filepath_anns)):
-            ome.structured_annotations.append(filepath_anns[i])
+            ome.add_annotation(filepath_anns[i])
             f.annotation_ref.append(refs[i])
-        if f.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(f)
+        ome.add_annotation(f)
         obj.annotation_ref.append(ref)
 
 
 def list_file_ids(ome: OME) -> dict:
     id_list = {}
+    paths = ServerPathIndex(ome.structured_annotations)
     for img in ome.images:
-        path = get_server_path(img.annotation_refs, ome.structured_annotations)
+        path = paths.get_server_path(img)
         id_list[img.id] = path
     for ann in ome.structured_annotations:
         if isinstance(ann, FileAnnotation):
             if ann.namespace != "omero.web.figure.json":
-                path = get_server_path(ann.annotation_refs,
-                                       ome.structured_annotations)
+                path = paths.get_server_path(ann)
             id_list[ann.id] = path
     return id_list
 
 
+def set_metadata_md5(ann: XMLAnnotation, md5: str):
+    tree = ETree.fromstring(to_xml(ann.value, canonicalize=True))
+    for el in tree:
+        if el.tag.rpartition('}')[2] == "CLITransferMetadata":
+            md_dict = {el2.tag.rpartition('}')[2]: el2.text for el2 in el}
+            if "md5" in md_dict:
+                md_dict["md5"] = md5
+                ann.value = create_metadata_xml(md_dict)
+
+
+def populate_checksums(ome: OME,
+                       object_files: Dict[str, List[Dict[str, Any]]]):
+    """
+    Record the size, SHA-1 and MD5 of every packed file in a single
+    CLITransferChecksums annotation, and fill the `md5` provenance field
+    of each image and plate with the MD5 of its file (or, for several
+    files, the MD5 of their sorted MD5s).
+    """
+    global ann_count
+    ns = 'openmicroscopy.org/cli/transfer'
+    files = {}
+    for recs in object_files.values():
+        for rec in recs:
+            files[rec["path"]] = rec
+    if not files:
+        return
+    index = OMEIndex(ome)
+    # metadata may come from an earlier run (--resume), so check the id
+    while f"Annotation:{ann_count}" in index.annotations:
+        ann_count += 1
+    an, _ = create_xml_and_ref(
+        id=ann_count, namespace=ns,
+        value=create_checksums_xml([files[p] for p in sorted(files)]))
+    ann_count += 1
+    ome.structured_annotations.append(an)
+    targets = [(img, object_files.get(img.id)) for img in ome.images]
+    for pl in ome.plates:
+        recs: Optional[List[Dict[str, Any]]] = []
+        for well in pl.wells:
+            for ws in well.well_samples:
+                if ws.image_ref is None or recs is None:
+                    continue
+                img_recs = object_files.get(ws.image_ref.id)
+                recs = recs + img_recs if img_recs is not None else None
+        targets.append((pl, recs))
+    for obj, recs in targets:
+        if not recs or not all(r.get("md5") and not r.get("failed")
+                               for r in recs):
+            continue
+        md5s = sorted(r["md5"] for r in {r["path"]: r for r in recs}.values())
+        if len(md5s) == 1:
+            md5 = md5s[0]
+        else:
+            md5 = hashlib.md5("\n".join(md5s).encode()).hexdigest()
+        for ref in obj.annotation_refs:
+            ann = index.annotations.get(ref.id)
+            if isinstance(ann, XMLAnnotation) and ann.namespace == ns:
+                set_metadata_md5(ann, md5)
+
+
 def populate_xml(datatype: str, id: int, filepath: str, conn: BlitzGateway,
                  hostname: str, barchive: bool, simple: bool, figure: bool,
-                 metadata: List[str]) -> Tuple[OME, dict]:
-    ome = OME()
+                 metadata: List[str],
+                 filesets: Optional[FilesetCache] = None,
+                 provenance: Optional[Dict[str, Any]] = None
+                 ) -> Tuple[OME, dict]:
+    ome = OMEIndex()
     global ann_count
     ann_count = uuid4().int >> 64
+    if filesets is None:
+        filesets = FilesetCache()
+    if metadata and provenance is None:
+        provenance = create_provenance_context(conn, hostname)
     obj = conn.getObject(datatype, id)
+    if datatype in ['Project', 'Dataset', 'Image']:
+        graph = load_container_graph(conn, datatype, [id], filesets)
+        graph['provenance'] = provenance
     if datatype == 'Project':
-        populate_project(obj, ome, conn, hostname, metadata, simple)
+        populate_project(graph['projects'][id], ome, conn, hostname,
+                         metadata, simple, graph)
     elif datatype == 'Dataset':
-        populate_dataset(obj, ome, conn, hostname, metadata, simple)
+        populate_dataset(graph['datasets'][id], ome, conn, hostname,
+                         metadata, simple, graph)
     elif datatype == 'Image':
-        populate_image(obj, ome, conn, hostname, metadata, simple)
+        populate_image(graph['images'][id], ome, conn, hostname, metadata,
+                       simple, graph=graph)
     elif datatype == 'Screen':
-        populate_screen(obj, ome, conn, hostname, metadata)
+        populate_screen(obj, ome, conn, hostname, metadata, filesets,
+                        provenance)
     elif datatype == 'Plate':
-        populate_plate(obj, ome, conn, hostname, metadata)
+        graph = load_container_graph(conn, datatype, [id], filesets)
+        graph['provenance'] = provenance
+        populate_plate(obj, ome, conn, hostname, metadata, graph)
+    populate_rois(ome, conn)
     if (not (barchive or simple)) and figure:
         populate_figures(ome, conn, filepath)
     if not barchive:
         with open(filepath, 'w') as fp:
-            print(to_xml(ome), file=fp)
+            print(to_xml(ome.ome), file=fp)
             fp.close()
-    path_id_dict = list_file_ids(ome)
-    return ome, path_id_dict
+    path_id_dict = list_file_ids(ome.ome)
+    return ome.ome, path_id_dict
 
 
 def populate_xml_folder(folder: str, filelist: bool, conn: BlitzGateway,
@@ -1053,9 +1452,10 @@ def populate_rocrate(datatype: str, ome: OME, filepath: str,
         print("RO-Crate export of Plate/Screen currently unsupported")
         return
     rc = ROCrate()
+    images = OMEIndex(ome).images
     files = path_id_dict.items()
     for id, file in files:
-        img = next(filter(lambda x: x.id == id, ome.images))
+        img = images[id]
         format = mimetypes.MimeTypes().guess_type(file)[0]
         if not format:
             format = "image"
@@ -1067,12 +1467,11 @@ def populate_rocrate(datatype: str, ome: OME, filepath: str,
     return
 
 
-def populate_figures(ome: OME, conn: BlitzGateway, filepath: str):
-    cli = CLI()
-    cli.loadplugins()
+def populate_figures(ome: OMEIndex, conn: BlitzGateway, filepath: str):
+    downloader = FileDownloader(conn)
     clean_img_ids = []
-    for img in ome.images:
-        clean_img_ids.append(img.id.split(":")[-1])
+    for img_id in ome.images:
+        clean_img_ids.append(img_id.split(":")[-1])
     q = conn.getQueryService()
     params = Parameters()
     results = q.projection(
@@ -1086,10 +1485,10 @@ def populate_figures(ome: OME, conn: BlitzGateway, filepath: str):
         parent = Path(filepath).parent
         figure_dir = parent / "figures"
         os.makedirs(figure_dir, exist_ok=True)
+        downloader.load_annotations(figure_ids)
     for fig in figure_ids:
         filepath = figure_dir / ("Figure_" + str(fig) + ".json")
-        cmd = ['download', "FileAnnotation:" + str(fig), str(filepath)]
-        cli.invoke(cmd)
+        downloader.download_annotation(fig, str(filepath))
         f = open(filepath, 'r').read()
         has_images = False
         for img in clean_img_ids:
@@ -1114,9 +1513,9 @@ def populate_figures(ome: OME, conn: BlitzGateway, filepath: str):
                                            namespace=fig_obj.getNs(),
                                            binary_file=binaryfile)
             filepath_ann, ref = create_figure_annotations(f.id)
-            ome.structured_annotations.append(filepath_ann)
+            ome.add_annotation(filepath_ann)
             f.annotation_ref.append(ref)
-            ome.structured_annotations.append(f)
+            ome.add_annotation(f)
         else:
             os.remove(filepath)
     if not os.listdir(figure_dir):
@@ -1124,19 +1523,17 @@ def populate_figures(ome: OME, conn: BlitzGateway, filepath: str):
     return
 
 
-def generate_columns(ome: OME, ids: dict) -> List[str]:
+def generate_columns(ome: OMEIndex, ids: dict) -> List[str]:
     columns = ["filename"]
     if [v for v in ids.values() if v.startswith("file_annotations")]:
         columns.append("data_type")
-    for ann in ome.structured_annotations:
+    for ann in ome.annotations.values():
         if isinstance(ann, CommentAnnotation) and ("comment" not in columns):
             clean_id = int(ann.id.split(":")[-1])
             if clean_id > 0:
                 columns.append("comment")
-    anns = ome.structured_annotations
-    for i in ome.images:
-        for ann_ref in i.annotation_refs:
-            ann = next(filter(lambda x: x.id == ann_ref.id, anns))
+    for i in ome.images.values():
+        for ann in ome.get_annotations(i.annotation_refs):
             if isinstance(ann, MapAnnotation):
                 for v in ann.value.ms:
                     if v.k not in columns:
@@ -1175,7 +1572,7 @@ def find_dataset(id: str, ome: OME) -> Union[str, None]:
     return None
 
 
-def generate_lines_and_move(img: Image, ome: OME, ids: dict, folder: str,
+def generate_lines_and_move(img: Image, ome: OMEIndex, ids: dict, folder: str,
                             top_level: str, lines: List[List[str]],
                             columns: List[str]) -> dict:
     # Note that if an image is in multiple datasets (or a dataset in multiple
@@ -1191,13 +1588,13 @@ def generate_lines_and_move(img: Image, ome: OME, ids: dict, folder: str,
             clean_paths.append(p)
     else:
         clean_paths = [Path(orig_path.rsplit("/", 1)[1])]
-    ds_name = find_dataset(img.id, ome)
+    ds_name = find_dataset(img.id, ome.ome)
     if not ds_name:
         ds_name = ""
     paths = {}
     orig_parent = Path(orig_path).parent
     if top_level == 'Project':
-        proj_name = ome.projects[0].name
+        proj_name = ome.ome.projects[0].name
         if not proj_name:
             proj_name = ""
         for p in clean_paths:
@@ -1228,12 +1625,9 @@ def generate_lines_and_move(img: Image, ome: OME, ids: dict, folder: str,
     return paths
 
 
-def get_annotation_vals(cols: List[str], img: Image, ome: OME) -> List[str]:
-    anns = []
-    for annref in img.annotation_refs:
-        a = next(filter(lambda x: x.id == annref.id,
-                 ome.structured_annotations))
-        anns.append(a)
+def get_annotation_vals(cols: List[str], img: Image, ome: OMEIndex
+                        ) -> List[str]:
+    anns = ome.get_annotations(img.annotation_refs)
     vals = []
     commented = False
     for col in cols:
@@ -1310,14 +1704,15 @@ def delete_empty_folders(root: str) -> set:
 
 def write_lines(top_level: str, ome: OME, fp: TextIO, ids: dict,
                 folder: str):
-    columns = generate_columns(ome, ids)
+    index = OMEIndex(ome)
+    columns = generate_columns(index, ids)
     columns.append("original_omero_ids")
     writer = csv.writer(fp, delimiter='\t')
     writer.writerow(columns)
     lines: List[List[str]] = []
     paths = []
     for i in ome.images:
-        tmppaths = generate_lines_and_move(i, ome, ids, folder,
+        tmppaths = generate_lines_and_move(i, index, ids, folder,
                                            top_level, lines, columns)
         paths.append(tmppaths)
     for line in lines:
@@ -0,0 +1,110 @@
+# Copyright (C) 2022 The Jackson Laboratory
+# All rights reserved.
+#
+# Use is subject to license terms supplied in LICENSE.
+
+from ome_types import OME, to_xml
+from ome_types.model import Project, Dataset, Screen, Plate, Image, ROI
+from ome_types.model import AnnotationRef, XMLAnnotation
+from typing import Any, Dict, List, Optional, Tuple
+import xml.etree.cElementTree as ETree
+
+
+class OMEIndex:
+    """
+    OME model being built by populate_* (or read back from transfer.xml),
+    with id -> object maps next to the collections that get appended to,
+    for O(1) dedupe and lookup.
+    """
+
+    def __init__(self, ome: Optional[OME] = None):
+        if ome is None:
+            ome = OME()
+        self.ome = ome
+        self.projects = {i.id: i for i in ome.projects}
+        self.datasets = {i.id: i for i in ome.datasets}
+        self.screens = {i.id: i for i in ome.screens}
+        self.plates = {i.id: i for i in ome.plates}
+        self.images = {i.id: i for i in ome.images}
+        self.rois = {i.id: i for i in ome.rois}
+        self.annotations = {i.id: i for i in ome.structured_annotations}
+
+    @staticmethod
+    def _add(obj: Any, index: dict, collection: list) -> bool:
+        if obj.id in index:
+            return False
+        index[obj.id] = obj
+        collection.append(obj)
+        return True
+
+    def add_project(self, proj: Project) -> bool:
+        return self._add(proj, self.projects, self.ome.projects)
+
+    def add_dataset(self, ds: Dataset) -> bool:
+        return self._add(ds, self.datasets, self.ome.datasets)
+
+    def add_screen(self, scr: Screen) -> bool:
+        return self._add(scr, self.screens, self.ome.screens)
+
+    def add_plate(self, pl: Plate) -> bool:
+        return self._add(pl, self.plates, self.ome.plates)
+
+    def add_image(self, img: Image) -> bool:
+        return self._add(img, self.images, self.ome.images)
+
+    def add_roi(self, roi: ROI) -> bool:
+        return self._add(roi, self.rois, self.ome.rois)
+
+    def add_annotation(self, ann: Any) -> bool:
+        return self._add(ann, self.annotations,
+                         self.ome.structured_annotations)
+
+    def get_annotations(self, refs: List[AnnotationRef]) -> List[Any]:
+        return [self.annotations[r.id] for r in refs
+                if r.id in self.annotations]
+
+
+class ServerPathIndex:
+    """
+    Contents of the CLITransferServerPath and CLITransferMetadata
+    XMLAnnotations of an OME document, each parsed once, by annotation
+    id; server paths are also memoized by the id of the annotated object.
+    File checksums from CLITransferChecksums are kept by pack path.
+    """
+
+    def __init__(self, anns: List[Any]):
+        # annotation id -> (position in `anns`, path)
+        self.paths: Dict[str, Tuple[int, str]] = {}
+        self.metadata: Dict[str, Dict[str, str]] = {}
+        self.objects: Dict[str, Optional[str]] = {}
+        self.checksums: Dict[str, Dict[str, str]] = {}
+        for pos, ann in enumerate(anns):
+            if not isinstance(ann, XMLAnnotation):
+                continue
+            tree = ETree.fromstring(to_xml(ann.value, canonicalize=True))
+            for el in tree:
+                tag = el.tag.rpartition('}')[2]
+                if tag == "CLITransferServerPath":
+                    for el2 in el:
+                        if el2.tag.rpartition('}')[2] == "Path":
+                            self.paths[ann.id] = (pos, el2.text)
+                elif tag == "CLITransferMetadata":
+                    self.metadata[ann.id] = {
+                        el2.tag.rpartition('}')[2]: el2.text for el2 in el}
+                elif tag == "CLITransferChecksums":
+                    for el2 in el:
+                        if el2.tag.rpartition('}')[2] == "File":
+                            self.checksums[el2.get("Path")] = {
+                                k.lower(): v for k, v in el2.items()
+                                if k != "Path"}
+
+    def get_server_path(self, obj: Any) -> Optional[str]:
+        """
+        Path of the first (in document order) server path annotation
+        referenced by `obj`, as `get_server_path` would return.
+        """
+        if obj.id not in self.objects:
+            found = [self.paths[r.id] for r in obj.annotation_refs
+                     if r.id in self.paths]
+            self.objects[obj.id] = min(found)[1] if found else None
+        return self.objects[obj.id]
@@ -16,20 +16,29 @@ import os
 import copy
 from functools import wraps
 import shutil
+import tempfile
+import threading
 from typing import DefaultDict
-import hashlib
-from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 from typing import Callable, List, Any, Dict, Union, Optional, Tuple
-import xml.etree.cElementTree as ETree
+from yaml import safe_load
 
 from generate_xml import populate_xml, populate_tsv, populate_rocrate
-from generate_xml import populate_xml_folder
-from generate_omero_objects import populate_omero, get_server_path
-
-import ezomero
-from ome_types.model import XMLAnnotation, OME
+from generate_xml import populate_xml_folder, FilesetCache
+from generate_xml import create_provenance_context, populate_checksums
+from generate_omero_objects import populate_omero
+from generate_omero_objects import SAVE_BATCH_SIZE
+from download_files import FileDownloader, DownloadManifest
+from download_files import DEFAULT_BLOCK_SIZE
+from archive_files import ArchiveWriter, COMPRESS_FORMATS
+from archive_files import extract_archive, PackReader, remove_extracted
+from archive_files import verify_files
+from download_files import DEFAULT_READAHEAD
+from ome_index import ServerPathIndex
+from omero_queries import query_by_ids
+
+from ome_types.model import OME
 from ome_types import from_xml, to_xml
-from omero.sys import Parameters
 from omero.rtypes import rstring
 from omero.cli import CLI, GraphControl, GraphArg
 from omero.cli import NonZeroReturnCode
@@ -38,7 +47,6 @@ from omero.grid import ManagedRepositoryPrx as MRepo
 
 
 DIR_PERM = 0o755
-MD5_BUF_SIZE = 65536
 
 
 HELP = ("""Transfer objects and annotations between servers.
@@ -80,6 +88,23 @@ for projects/datasets, with files being placed according to where they come
 from in the server. Note this a package generated with this option is NOT
 guaranteed to work with unpack.
 
+--compress packs into a tar.gz or tar.zst file, compressed on
+--compress_threads threads (default: one per CPU) at --compress_level. Large
+files that do not compress are stored as they are.
+
+--workers sets how many filesets/attachments are downloaded in parallel
+over the current session. Default is 1.
+
+--resume keeps a manifest of the generated metadata and of every downloaded
+file (with its size and checksum) in the staging folder, which is no longer
+removed when a download fails. Running the same command again reuses the
+metadata and only downloads the files that are missing or no longer match
+their recorded size and checksum.
+
+--block_size and --readahead tune how files are streamed from the server:
+the size in bytes of each read (default 1MiB) and how many reads are kept in
+flight ahead of the one being written (default 4).
+
 --metadata allows you to specify which transfer metadata will be saved in
 `transfer.xml` as possible MapAnnotation values to the images. Default is `all`
 (equivalent to `img_id timestamp software version hostname md5 orig_user
@@ -99,6 +124,9 @@ omero transfer pack --zip Image:123 transfer_pack.zip
 omero transfer pack Dataset:1111 /home/user/new_folder/new_pack.tar
 omero transfer pack 999 tarfile.tar  # equivalent to Project:999
 omero transfer pack 1 transfer_pack.tar --metadata img_id version db_id
+omero transfer pack --workers 4 Project:999 transfer_pack.tar
+omero transfer pack --compress tar.zst Project:999 transfer_pack.tar.zst
+omero transfer pack --resume Project:999 transfer_pack.tar
 omero transfer pack --binaries none Dataset:1111 /home/user/new_folder/
 omero transfer pack --binaries all Dataset:1111 /home/user/new_folder/pack.tar
 """)
@@ -115,6 +143,20 @@ files. Same restrictions of regular in-place imports apply.
 --output allows for specifying an optional output folder where the packet
 will be unzipped.
 
+--extract_workers sets how many zip members are extracted in parallel
+(default: one per CPU).
+
+--on_demand only extracts each image file (or fileset folder) from the pack
+right before it is imported, and deletes it once the import succeeded, so at
+most one fileset is on disk at a time. Needs a zip or uncompressed tar pack
+and cannot be combined with --ln_s_import or --folder.
+
+--import_workers sets how many files are imported at the same time (default:
+1). Image mapping is the same as with sequential imports.
+
+--batch_size sets how many annotations (or renamed images and plates) are
+saved per server call (default: 1000).
+
 --folder allows the user to point to a previously-unpacked folder rather than
 a single file.
 
@@ -135,11 +177,16 @@ options are `none`, `img_id`, `timestamp`, `software`, `version`, `md5`,
 `hostname`, `db_id`, `orig_user`, `orig_group`.
 
 You can also pass all --skip options that are allowed by `omero import` (all,
-checksum, thumbnails, minmax, upgrade).
+checksum, thumbnails, minmax, upgrade). Unpacked files are checked against
+the sizes and checksums recorded in `transfer.xml` before they are imported,
+unless `--skip` is `all` or `checksum`. Files recorded as failed when the pack
+was made (with `--ignore_errors`) are always rejected.
 
 Examples:
 omero transfer unpack transfer_pack.zip
 omero transfer unpack --output /home/user/optional_folder --ln_s
+omero transfer unpack --on_demand transfer_pack.tar
+omero transfer unpack --import_workers 4 transfer_pack.zip
 omero transfer unpack --folder /home/user/unpacked_folder/ --skip upgrade
 omero transfer unpack pack.tar --metadata db_id orig_user hostname
 """)
@@ -222,6 +269,16 @@ class TransferControl(GraphControl):
         pack.add_argument(
                 "--zip", help="Pack into a zip file rather than a tarball",
                 action="store_true")
+        pack.add_argument(
+                "--compress", choices=COMPRESS_FORMATS,
+                help="Pack into a compressed tarball")
+        pack.add_argument(
+                "--compress_level", type=int,
+                help="Compression level for --compress or --zip")
+        pack.add_argument(
+                "--compress_threads", type=int,
+                help="Number of threads compressing a --compress tarball "
+                     "(default: number of CPUs)")
         pack.add_argument(
                 "--figure", help="Include OMERO.Figures into the pack"
                                  " (caveats apply)",
@@ -241,6 +298,23 @@ class TransferControl(GraphControl):
                 "--ignore_errors", help="Ignores any download/export errors "
                                         "during the pack process",
                 action="store_true")
+        pack.add_argument(
+                "--workers", help="Number of files to download in "
+                                  "parallel (default: 1)",
+                type=int, default=1)
+        pack.add_argument(
+                "--resume", help="Keep a manifest of downloaded files in the"
+                                 " staging folder and continue an "
+                                 "interrupted pack from it",
+                action="store_true")
+        pack.add_argument(
+                "--block_size", help="Size in bytes of each read when "
+                                     "downloading files (default: 1MiB)",
+                type=int, default=DEFAULT_BLOCK_SIZE)
+        pack.add_argument(
+                "--readahead", help="Number of reads kept in flight while "
+                                    "downloading a file (default: 4)",
+                type=int, default=DEFAULT_READAHEAD)
         pack.add_argument(
             "--metadata",
             choices=['all', 'none', 'img_id', 'timestamp',
@@ -280,6 +354,21 @@ class TransferControl(GraphControl):
             "--output", type=str, help="Output directory where zip "
                                        "file will be extracted"
         )
+        unpack.add_argument(
+            "--extract_workers", type=int,
+            help="Number of zip members extracted in parallel "
+                 "(default: number of CPUs)")
+        unpack.add_argument(
+            "--on_demand", action="store_true",
+            help="Extract each fileset right before importing it and "
+                 "delete it afterwards")
+        unpack.add_argument(
+            "--import_workers", type=int, default=1,
+            help="Number of files imported in parallel (default: 1)")
+        unpack.add_argument(
+            "--batch_size", type=int, default=SAVE_BATCH_SIZE,
+            help="Number of objects saved per server call "
+                 f"(default: {SAVE_BATCH_SIZE})")
         unpack.add_argument(
             "--skip", choices=['all', 'checksum', 'thumbnails', 'minmax',
                                'upgrade'],
@@ -327,7 +416,19 @@ class TransferControl(GraphControl):
         return mrepos
 
     def _copy_files(self, id_list: Dict[str, Any], folder: str,
-                    ignore_errors: bool, conn: BlitzGateway):
+                    ignore_errors: bool, conn: BlitzGateway,
+                    filesets: Optional[FilesetCache] = None,
+                    workers: int = 1,
+                    block_size: int = DEFAULT_BLOCK_SIZE,
+                    readahead: int = DEFAULT_READAHEAD,
+                    manifest: Optional[DownloadManifest] = None,
+                    archive: Optional[ArchiveWriter] = None
+                    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Download the files behind `id_list` into `folder` (or `archive`)
+        and return, per object id, the checksum records of its files, each
+        with its `path` inside the pack.
+        """
         if not isinstance(id_list, dict):
             raise TypeError("id_list must be a dict")
         if not all(isinstance(item, str) for item in id_list.keys()):
@@ -336,77 +437,154 @@ class TransferControl(GraphControl):
             raise TypeError("folder must be a string")
         if not isinstance(conn, BlitzGateway):
             raise TypeError("invalid type for connection object")
-        cli = CLI()
-        cli.loadplugins()
-        downloaded_ids = []
+        if filesets is None:
+            filesets = FilesetCache()
+        filesets.load_images(conn, [int(id.split(":")[-1]) for id in id_list
+                                    if id.startswith("Image")])
+        downloads = []
+        targets: Dict[str, List[str]] = {}
+        image_filesets = {}
+        fileset_folders = {}
         for id in id_list:
             clean_id = int(id.split(":")[-1])
             dtype = id.split(":")[0]
             if (dtype == "Image"):
-                if (clean_id not in downloaded_ids):
+                fileset = filesets.fileset_of(conn, clean_id)
+                image_filesets[id] = fileset
+                if (fileset not in filesets.downloaded):
                     path = id_list[id]
                     rel_path = path
                     rel_path = str(Path(rel_path).parent)
                     subfolder = os.path.join(str(Path(folder)), rel_path)
-                    os.makedirs(subfolder, mode=DIR_PERM, exist_ok=True)
-                    obj = conn.getObject("Image", clean_id)
-                    fileset = obj.getFileset()
+                    if archive is None:
+                        os.makedirs(subfolder, mode=DIR_PERM, exist_ok=True)
                     if rel_path == "pixel_images" or fileset is None:
                         filepath = str(Path(subfolder) /
                                        (str(clean_id) + ".tiff"))
-                        if not ignore_errors:
-                            try:
-                                cli.invoke(['export', '--file', filepath, id],
-                                           strict=True)
-                            except NonZeroReturnCode:
-                                print("A file could not be exported - this is "
-                                      "generally due to a server not allowing"
-                                      " binary downloads.")
-                                shutil.rmtree(folder)
-                                raise NonZeroReturnCode(1, "Download not \
-                                                        allowed")
-                        else:
-                            cli.invoke(['export', '--file', filepath, id])
-                        downloaded_ids.append(id)
+                        downloads.append(('export', clean_id, filepath))
+                        targets[id] = [filepath]
                     else:
-                        if not ignore_errors:
-                            try:
-                                cli.invoke(['download', id, subfolder],
-                                           strict=True)
-                            except NonZeroReturnCode:
-                                print("A file could not be downloaded - this "
-                                      "is generally due to a server not "
-                                      "allowing binary downloads.")
-                                shutil.rmtree(folder)
-                                raise NonZeroReturnCode(1, "Download not \
-                                                        allowed")
-                        else:
-                            cli.invoke(['download', id, subfolder])
-                        for fs_image in fileset.copyImages():
-                            downloaded_ids.append(fs_image.getId())
+                        downloads.append(('fileset', fileset, subfolder))
+                        filesets.downloaded.add(fileset)
+                        fileset_folders[fileset] = subfolder
             else:
                 path = id_list[id]
                 rel_path = path
                 subfolder = os.path.join(str(Path(folder)), rel_path)
                 ann_folder = str(Path(subfolder).parent)
-                os.makedirs(ann_folder, mode=DIR_PERM, exist_ok=True)
-                id = "File" + id
-                if not ignore_errors:
-                    try:
-                        cli.invoke(['download', id, subfolder], strict=True)
-                    except NonZeroReturnCode:
-                        print("A file could not be downloaded - this is "
-                              "generally due to a server not allowing"
-                              " binary downloads.")
-                        shutil.rmtree(folder)
-                        raise NonZeroReturnCode(1, "Download not allowed")
+                if archive is None:
+                    os.makedirs(ann_folder, mode=DIR_PERM, exist_ok=True)
+                downloads.append(('annotation', clean_id, subfolder))
+                targets[id] = [subfolder]
+        downloader = FileDownloader(conn, block_size, readahead, manifest,
+                                    archive)
+        downloader.load_filesets([i for kind, i, _ in downloads
+                                  if kind == 'fileset'])
+        downloader.load_annotations([i for kind, i, _ in downloads
+                                     if kind == 'annotation'])
+        self._run_downloads(downloads, folder, ignore_errors, downloader,
+                            workers)
+        for id, fileset in image_filesets.items():
+            if fileset in fileset_folders:
+                targets[id] = [t for t, _ in downloader.fileset_targets(
+                    fileset, fileset_folders[fileset])]
+        records = {}
+        for target, checksums in downloader.files.items():
+            path = Path(os.path.relpath(target, folder)).as_posix()
+            records[target] = dict(checksums, path=path)
+        # objects with a file that failed (--ignore_errors) get no record
+        return {id: [records[t] for t in paths] for id, paths in
+                targets.items() if all(t in records for t in paths)}
+
+    def _run_downloads(self, downloads: List[Tuple[str, int, str]],
+                       folder: str, ignore_errors: bool,
+                       downloader: FileDownloader, workers: int = 1):
+        """
+        Runs (kind, id, target) downloads on `workers` threads sharing the
+        current session. With `ignore_errors`, a file that fails (download
+        refused, checksum mismatch, archive member not written) is reported
+        and skipped. Otherwise the first failure cancels pending downloads,
+        waits for running ones, and only then removes `folder` (which is
+        kept for a later run if the downloader has a manifest).
+        """
+        def run(download: Tuple[str, int, str]):
+            kind, obj_id, target = download
+            try:
+                if kind == 'export':
+                    downloader.export_image(obj_id, target)
+                elif kind == 'fileset':
+                    downloader.download_fileset(obj_id, target)
                 else:
-                    cli.invoke(['download', id, subfolder])
+                    downloader.download_annotation(obj_id, target)
+            except (NonZeroReturnCode, RuntimeError) as e:
+                if not ignore_errors:
+                    raise
+                print(f"Skipping {kind} {obj_id}: {e}")
+
+        failed = None
+        error: Optional[BaseException] = None
+        if workers <= 1:
+            for download in downloads:
+                try:
+                    run(download)
+                except NonZeroReturnCode as e:
+                    failed, error = download, e
+                    break
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(run, download): download
+                           for download in downloads}
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    if future.exception() is not None:
+                        failed = futures[future]
+                        error = future.exception()
+                        break
+                if failed:
+                    for future in futures:
+                        future.cancel()
+        if error is None:
+            return
+        if not isinstance(error, NonZeroReturnCode):
+            raise error
+        if failed[0] == "export":
+            print("A file could not be exported - this is "
+                  "generally due to a server not allowing"
+                  " binary downloads.")
+        else:
+            print("A file could not be downloaded - this is "
+                  "generally due to a server not allowing"
+                  " binary downloads.")
+        if downloader.manifest is None:
+            shutil.rmtree(folder)
+        raise NonZeroReturnCode(1, "Download not allowed")
 
-    def _package_files(self, tar_path: str, zip: bool, folder: str):
+    def _archive_base(self, tar_path: Path,
+                      compress: Optional[str] = None) -> str:
+        if compress and str(tar_path).endswith("." + compress):
+            return str(tar_path)[:-len(compress) - 1]
+        return os.path.splitext(tar_path)[0]
+
+    def _archive_path(self, tar_path: str, zip: bool,
+                      compress: Optional[str] = None) -> str:
+        # same name as shutil.make_archive gives in _package_files
         if zip:
-            print("Creating zip file...")
-            shutil.make_archive(tar_path, 'zip', folder)
+            return tar_path + ".zip"
+        if compress:
+            return tar_path + "." + compress
+        return tar_path + ".tar"
+
+    def _package_files(self, tar_path: str, zip: bool, folder: str,
+                       compress: Optional[str] = None,
+                       level: Optional[int] = None,
+                       threads: Optional[int] = None):
+        if zip or compress:
+            print(f"Creating {'zip' if zip else compress} file...")
+            archive = ArchiveWriter(
+                self._archive_path(tar_path, zip, compress), zip, folder,
+                compress, level, threads)
+            archive.add_folder(folder)
+            archive.close()
         else:
             print("Creating tar file...")
             shutil.make_archive(tar_path, 'tar', folder)
@@ -422,11 +600,13 @@ class TransferControl(GraphControl):
         if "none" in metadata:
             metadata = None
         if metadata:
-            metadata = list(set(metadata))
+            # sorted, so runs with the same options record the same list
+            metadata = sorted(set(metadata))
         self.metadata = metadata
 
-    def _fix_pixels_image_simple(self, ome: OME, folder: str, filepath: str
-                                 ) -> OME:
+    def _fix_pixels_image_simple(self, ome: OME, folder: str, filepath: str,
+                                 object_files: Optional[Dict[str, List[
+                                     Dict[str, Any]]]] = None) -> OME:
         newome = copy.deepcopy(ome)
         for ann in ome.structured_annotations:
             if isinstance(ann.value, str) and\
@@ -448,6 +628,10 @@ class TransferControl(GraphControl):
                 os.makedirs(subfolder, mode=DIR_PERM, exist_ok=True)
                 shutil.move(os.path.join(str(Path(folder)), path1),
                             os.path.join(str(Path(folder)), path2))
+                for recs in (object_files or {}).values():
+                    for rec in recs:
+                        if rec["path"] == Path(path1).as_posix():
+                            rec["path"] = Path(path2).as_posix()
         if os.path.exists(os.path.join(str(Path(folder)), "pixel_images")):
             shutil.rmtree(os.path.join(str(Path(folder)), "pixel_images"))
         with open(filepath, 'w') as fp:
@@ -487,6 +671,9 @@ class TransferControl(GraphControl):
                 raise ValueError("Single plate or screen cannot be "
                                  "packaged in human-readable format")
 
+        if args.zip and args.compress:
+            raise ValueError("The `--zip` and `--compress` options are "
+                             "incompatible")
         if (args.binaries == "none") and args.simple:
             raise ValueError("The `--binaries none` and `--simple` options "
                              "are  incompatible")
@@ -501,48 +688,93 @@ class TransferControl(GraphControl):
                              "once")
         self.metadata = []
         self._process_metadata(args.metadata)
-        path_id_dict = {}
-        ome = OME()
         for dataid in src_dataids:
             obj = self.gateway.getObject(src_datatype, dataid)
             if obj is None:
                 raise ValueError("At least one object not found or outside"
                                  " current permissions for current user.")
-            print("Populating xml...")
-            tar_path = Path(args.filepath)
-            if args.binaries == "all":
-                folder = str(tar_path) + "_folder"
-            else:
-                folder = os.path.splitext(tar_path)[0]
-                print(f"Output will be written to {folder}")
-
-            os.makedirs(folder, mode=DIR_PERM, exist_ok=True)
-            if args.barchive:
-                md_fp = str(Path(folder) / "submission.tsv")
-            elif args.rocrate:
-                md_fp = str(Path(folder) / "ro-crate-metadata.json")
-            else:
-                md_fp = str(Path(folder) / "transfer.xml")
-                print(f"Saving metadata at {md_fp}.")
-            this_ome, this_id_dict = populate_xml(src_datatype, dataid, md_fp,
-                                                  self.gateway, self.hostname,
-                                                  args.barchive, args.simple,
-                                                  args.figure,
-                                                  self.metadata)
-            ome = self.__append_to_ome(ome, this_ome)
-            path_id_dict.update(this_id_dict)
-            # need to somehow merge omes/path_id_dicts
+        tar_path = Path(args.filepath)
+        if args.binaries == "all":
+            folder = str(tar_path) + "_folder"
+        else:
+            folder = os.path.splitext(tar_path)[0]
+            print(f"Output will be written to {folder}")
+        os.makedirs(folder, mode=DIR_PERM, exist_ok=True)
+        if args.barchive:
+            md_fp = str(Path(folder) / "submission.tsv")
+        elif args.rocrate:
+            md_fp = str(Path(folder) / "ro-crate-metadata.json")
+        else:
+            md_fp = str(Path(folder) / "transfer.xml")
+        manifest = None
+        if args.resume:
+            manifest = DownloadManifest(folder, {
+                "objects": [f"{src_datatype}:{i}" for i in src_dataids],
+                "barchive": args.barchive, "rocrate": args.rocrate,
+                "simple": args.simple, "figure": args.figure,
+                "metadata": self.metadata})
+        path_id_dict = {}
+        ome = OME()
+        filesets = FilesetCache()
+        if manifest is not None and manifest.id_list is not None:
+            print("Reusing metadata from previous run...")
+            ome = from_xml(manifest.metadata_path)
+            path_id_dict = manifest.id_list
+        else:
+            provenance = None
+            if self.metadata:
+                provenance = create_provenance_context(self.gateway,
+                                                       self.hostname)
+            for dataid in src_dataids:
+                print("Populating xml...")
+                if not (args.barchive or args.rocrate):
+                    print(f"Saving metadata at {md_fp}.")
+                this_ome, this_id_dict = populate_xml(
+                    src_datatype, dataid, md_fp, self.gateway,
+                    self.hostname, args.barchive, args.simple, args.figure,
+                    self.metadata, filesets, provenance)
+                ome = self.__append_to_ome(ome, this_ome)
+                path_id_dict.update(this_id_dict)
+            if manifest is not None:
+                manifest.save_metadata(to_xml(ome), path_id_dict)
         if not args.barchive:
             with open(md_fp, 'w') as fp:
                 print(to_xml(ome), file=fp)
                 fp.close()
+        object_files = {}
+        # without any post-processing of the downloaded files, they are
+        # written straight into the pack instead of the staging folder
+        archive = None
+        if args.binaries == "all" and not (args.resume or args.simple or
+                                           args.barchive or args.rocrate or
+                                           args.plugin):
+            archive = ArchiveWriter(
+                self._archive_path(self._archive_base(tar_path, args.compress),
+                                   args.zip, args.compress),
+                args.zip, folder, args.compress, args.compress_level,
+                args.compress_threads)
         if args.binaries == "all":
             print("Starting file copy...")
-            self._copy_files(path_id_dict, folder, args.ignore_errors,
-                             self.gateway)
+            try:
+                object_files = self._copy_files(
+                    path_id_dict, folder, args.ignore_errors, self.gateway,
+                    filesets, args.workers, args.block_size, args.readahead,
+                    manifest, archive)
+            except BaseException:
+                if archive is not None:
+                    archive.abort()
+                raise
+        if manifest is not None:
+            manifest.remove()
 
         if args.simple:
-            self._fix_pixels_image_simple(ome, folder, md_fp)
+            ome = self._fix_pixels_image_simple(ome, folder, md_fp,
+                                                object_files)
+        if object_files:
+            populate_checksums(ome, object_files)
+            if not args.barchive:
+                with open(md_fp, 'w') as fp:
+                    print(to_xml(ome), file=fp)
         if args.barchive:
             print(f"Creating Bioimage Archive TSV at {md_fp}.")
             populate_tsv(src_datatype, ome, md_fp,
@@ -580,9 +812,16 @@ class TransferControl(GraphControl):
                     tmp_path=Path(folder),
                     image_filenames_mapping=path_id_dict,
                     conn=self.gateway)
+        elif archive is not None:
+            print("Adding metadata to pack...")
+            archive.add_folder(folder)
+            archive.close()
+            print("Cleaning up...")
+            shutil.rmtree(folder)
         elif args.binaries == "all":
-            self._package_files(os.path.splitext(tar_path)[0], args.zip,
-                                folder)
+            self._package_files(self._archive_base(tar_path, args.compress),
+                                args.zip, folder, args.compress,
+                                args.compress_level, args.compress_threads)
             print("Cleaning up...")
             shutil.rmtree(folder)
         return
@@ -590,32 +829,72 @@ class TransferControl(GraphControl):
     def __unpack(self, args):
         self.metadata = []
         self._process_metadata(args.metadata)
-        if not args.folder:
+        if args.on_demand and (args.folder or args.ln_s_import):
+            raise ValueError("--on_demand cannot be used with --folder "
+                             "or --ln_s_import")
+        pack = None
+        if args.on_demand:
+            print(f"Indexing {args.filepath}...")
+            pack, ome, folder = self._open_pack(args.filepath, args.output)
+            hasher = ThreadPoolExecutor(max_workers=1)
+            stop_hash = threading.Event()
+            hash_future = hasher.submit(pack.md5, stop_hash)
+        elif not args.folder:
             print(f"Unzipping {args.filepath}...")
             hash, ome, folder = self._load_from_pack(args.filepath,
-                                                     args.output)
+                                                     args.output,
+                                                     args.extract_workers)
         else:
             folder = Path(args.filepath)
             ome = from_xml(folder / "transfer.xml")
             hash = "imported from folder"
         print("Generating Image mapping and import filelist...")
-        ome, src_img_map, filelist = self._create_image_map(ome)
+        paths = ServerPathIndex(ome.structured_annotations)
+        ome, src_img_map, filelist = self._create_image_map(ome, paths)
+        checksums = paths.checksums
+        if args.skip in ("all", "checksum"):
+            # members that failed when packed are rejected regardless
+            checksums = {p: r for p, r in checksums.items()
+                         if r.get("failed") == "true"}
+        if checksums and pack is None:
+            print("Verifying checksums...")
+            verify_files(str(folder), checksums,
+                         workers=args.extract_workers)
         print("Importing data as orphans...")
         if args.ln_s_import:
             ln_s = True
         else:
             ln_s = False
-        dest_img_map = self._import_files(folder, filelist,
-                                          ln_s, args.skip, self.gateway)
-        self._delete_all_rois(dest_img_map, self.gateway)
+        try:
+            if pack is not None:
+                extracted = pack.extract_except(filelist, str(folder))
+                if checksums:
+                    verify_files(str(folder), checksums, extracted)
+            dest_img_map = self._import_files(folder, filelist, ln_s,
+                                              args.skip, self.gateway, pack,
+                                              args.import_workers, checksums)
+        except BaseException:
+            # the pack hash is only needed if the imports succeed
+            if pack is not None:
+                stop_hash.set()
+                hash_future.cancel()
+                hasher.shutdown(wait=False)
+                pack.close()
+            raise
+        if pack is not None:
+            pack.close()
+            hash = hash_future.result()
+            hasher.shutdown()
         print("Matching source and destination images...")
         img_map = self._make_image_map(src_img_map, dest_img_map, self.gateway)
         print("Creating and linking OMERO objects...")
         populate_omero(ome, img_map, self.gateway,
-                       hash, folder, self.metadata, args.merge, args.figure)
+                       hash, folder, self.metadata, args.merge, args.figure,
+                       args.batch_size, paths)
         return
 
-    def _load_from_pack(self, filepath: str, output: Optional[str] = None
+    def _load_from_pack(self, filepath: str, output: Optional[str] = None,
+                        workers: Optional[int] = None
                         ) -> Tuple[str, OME, Path]:
         if (not filepath) or (not isinstance(filepath, str)):
             raise TypeError("filepath must be a string")
@@ -623,132 +902,154 @@ class TransferControl(GraphControl):
             raise TypeError("output folder must be a string")
         parent_folder = Path(filepath).parent
         filename = Path(filepath).resolve().stem
+        if Path(filepath).suffix in ('.gz', '.zst') and \
+                Path(filename).suffix == '.tar':
+            filename = Path(filename).stem
         if output:
             folder = Path(output)
         else:
             folder = parent_folder / filename
         if Path(filepath).exists():
-            with open(filepath, 'rb') as file:
-                md5 = hashlib.md5()
-                while True:
-                    data = file.read(MD5_BUF_SIZE)
-                    if not data:
-                        break
-                    md5.update(data)
-                hash = md5.hexdigest()
-            if Path(filepath).suffix == '.zip':
-                with ZipFile(filepath, 'r') as zipobj:
-                    zipobj.extractall(str(folder))
-            elif Path(filepath).suffix == '.tar':
-                shutil.unpack_archive(filepath, str(folder), 'tar')
-            else:
-                raise ValueError("File is not a zip or tar file")
+            hash = extract_archive(filepath, str(folder), workers)
         else:
             raise FileNotFoundError("filepath is not a zip file")
         ome = from_xml(folder / "transfer.xml")
         return hash, ome, folder
 
-    def _create_image_map(self, ome: OME
+    def _open_pack(self, filepath: str, output: Optional[str] = None
+                   ) -> Tuple[PackReader, OME, Path]:
+        # like _load_from_pack, but only transfer.xml is extracted
+        if (not filepath) or (not isinstance(filepath, str)):
+            raise TypeError("filepath must be a string")
+        if output and not isinstance(output, str):
+            raise TypeError("output folder must be a string")
+        if not Path(filepath).exists():
+            raise FileNotFoundError("filepath is not a zip file")
+        if output:
+            folder = Path(output)
+        else:
+            folder = Path(filepath).parent / Path(filepath).resolve().stem
+        pack = PackReader(filepath)
+        if not pack.extract("transfer.xml", str(folder)):
+            pack.close()
+            raise FileNotFoundError("transfer.xml not found in pack")
+        ome = from_xml(folder / "transfer.xml")
+        return pack, ome, folder
+
+    def _create_image_map(self, ome: OME,
+                          paths: Optional[ServerPathIndex] = None
                           ) -> Tuple[OME, DefaultDict, List[str]]:
         if not (isinstance(ome, OME)):
             raise TypeError("XML is not valid OME format")
+        if paths is None:
+            paths = ServerPathIndex(ome.structured_annotations)
         img_map = DefaultDict(list)
         filelist = []
         newome = copy.deepcopy(ome)
-        map_ref_ids = []
+        map_ref_ids = set()
         for img in ome.images:
-            fpath = get_server_path(img.annotation_refs,
-                                    ome.structured_annotations)
+            fpath = paths.get_server_path(img)
             img_map[fpath].append(int(img.id.split(":")[-1]))
             # use XML path annotation instead
             if fpath.endswith('mock_folder'):
                 filelist.append(fpath.rstrip("mock_folder"))
             else:
                 filelist.append(fpath)
-            for anref in img.annotation_refs:
-                for an in newome.structured_annotations:
-                    if anref.id == an.id and isinstance(an, XMLAnnotation):
-                        tree = ETree.fromstring(to_xml(an.value,
-                                                       canonicalize=True))
-                        for el in tree:
-                            if el.tag.rpartition('}')[2] == \
-                                    "CLITransferServerPath":
-                                newome.structured_annotations.remove(an)
-                                map_ref_ids.append(an.id)
+            map_ref_ids.update(ref.id for ref in img.annotation_refs
+                               if ref.id in paths.paths)
+        xml_anns = newome.structured_annotations.xml_annotations
+        xml_anns[:] = [an for an in xml_anns if an.id not in map_ref_ids]
         for i in newome.images:
-            for ref in i.annotation_refs:
-                if ref.id in map_ref_ids:
-                    i.annotation_refs.remove(ref)
+            i.annotation_refs[:] = [ref for ref in i.annotation_refs
+                                    if ref.id not in map_ref_ids]
         filelist = list(set(filelist))
         img_map = DefaultDict(list, {x: sorted(img_map[x])
                               for x in img_map.keys()})
         return newome, img_map, filelist
 
     def _import_files(self, folder: Path, filelist: List[str], ln_s: bool,
-                      skip: str, gateway: BlitzGateway) -> dict:
-        cli = CLI()
-        cli.loadplugins()
-        dest_map = {}
+                      skip: str, gateway: BlitzGateway,
+                      pack: Optional[PackReader] = None,
+                      workers: int = 1,
+                      checksums: Optional[Dict[str, Dict[str, str]]] = None
+                      ) -> dict:
+        """
+        Imports every file in `filelist`, up to `workers` at a time (each
+        thread with its own CLI), and maps each import path to the ids of
+        the images it created, in `filelist` order. Files extracted from
+        `pack` are checked against `checksums` before their import.
+        """
+        clis = threading.local()
         curr_folder = str(Path('.').resolve())
-        for filepath in filelist:
-            dest_path = str(os.path.join(curr_folder, folder,  '.', filepath))
-            command = ['import', dest_path]
+        dest_paths = [str(os.path.join(curr_folder, folder,  '.', filepath))
+                      for filepath in filelist]
+
+        def run(filepath: str, dest_path: str) -> List[str]:
+            if not hasattr(clis, "cli"):
+                clis.cli = CLI()
+                clis.cli.loadplugins()
+            cli = clis.cli
+            fd, output = tempfile.mkstemp(suffix=".yml")
+            os.close(fd)
+            command = ['import', dest_path, '--output', 'yaml',
+                       '--file', output]
             if ln_s:
                 command.append('--transfer=ln_s')
             if skip:
                 command.extend(['--skip', skip])
-            cli.invoke(command)
-            img_ids = self._get_image_ids(dest_path, gateway)
-            dest_map[dest_path] = img_ids
-        return dest_map
-
-    def _delete_all_rois(self, dest_map: dict, gateway: BlitzGateway):
-        roi_service = gateway.getRoiService()
-        for imgs in dest_map.values():
-            for img in imgs:
-                result = roi_service.findByImage(img, None)
-                for roi in result.rois:
-                    gateway.deleteObject(roi)
-        return
-
-    def _get_image_ids(self, file_path: str, conn: BlitzGateway) -> List[str]:
+            extracted = []
+            if pack is not None:
+                extracted = pack.extract(filepath, str(folder))
+                if checksums:
+                    verify_files(str(folder), checksums, extracted, 1)
+            try:
+                cli.invoke(command)
+                if pack is not None and cli.rv == 0:
+                    remove_extracted(extracted, str(folder))
+                with open(output) as fp:
+                    return self._get_image_ids(fp.read())
+            finally:
+                os.remove(output)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            img_ids = list(pool.map(run, filelist, dest_paths))
+        return dict(zip(dest_paths, img_ids))
+
+    def _get_image_ids(self, import_output: str) -> List[int]:
         """Get the Ids of imported images.
-        Note that this will not find images if they have not been imported.
+
+        Parameters
+        ----------
+        import_output : str
+            Output of ``omero import --output yaml``: one entry per
+            imported fileset, listing the ids of the objects created.
 
         Returns
         -------
         image_ids : list of ints
-            Ids of images imported from the specified client path, which
-            itself is derived from ``file_path``.
+            Sorted ids of all images created by the import; empty if
+            the import failed.
         """
-        q = conn.getQueryService()
-        params = Parameters()
-        path_query = str(file_path).strip('/')
-        params.map = {"cpath": rstring('%s%%' % path_query)}
-        results = q.projection(
-            "SELECT i.id FROM Image i"
-            " JOIN i.fileset fs"
-            " JOIN fs.usedFiles u"
-            " WHERE u.clientPath LIKE :cpath",
-            params,
-            conn.SERVICE_OPTS
-            )
-        all_image_ids = list(set(sorted([r[0].val for r in results])))
-        image_ids = []
-        for img_id in all_image_ids:
-            anns = ezomero.get_map_annotation_ids(conn, "Image", img_id)
-            if not anns:
-                image_ids.append(img_id)
-            else:
-                is_annotated = False
-                for ann in anns:
-                    ann_content = conn.getObject("MapAnnotation", ann)
-                    if ann_content.getNs() == \
-                            'openmicroscopy.org/cli/transfer':
-                        is_annotated = True
-                if not is_annotated:
-                    image_ids.append(img_id)
-        return image_ids
+        filesets = safe_load(import_output) or []
+        image_ids = set()
+        for fileset in filesets:
+            images = fileset.get("Image", [])
+            if not isinstance(images, list):
+                images = [images]
+            image_ids.update(int(i) for i in images)
+        return sorted(image_ids)
+
+    def _get_transferred_images(self, conn: BlitzGateway,
+                                image_ids: List[int]) -> set:
+        # images among `image_ids` already annotated by an earlier unpack
+        results = query_by_ids(
+            conn,
+            "SELECT DISTINCT l.parent.id FROM ImageAnnotationLink l"
+            " WHERE l.parent.id IN (:ids) AND l.child.ns LIKE :ns",
+            sorted(set(image_ids)), projection=True,
+            ctx={'omero.group': '-1'},
+            params={"ns": rstring("openmicroscopy.org/cli/transfer%")})
+        return set(r[0].val for r in results)
 
     def _make_image_map(self, source_map: dict, dest_map: dict,
                         conn: Optional[BlitzGateway] = None) -> dict:
@@ -770,24 +1071,15 @@ class TransferControl(GraphControl):
                                       for x in src_dict.keys()})
         dest_dict = DefaultDict(list, {x: sorted(dest_dict[x])
                                        for x in dest_dict.keys()})
+        transferred = set()
+        if conn:
+            transferred = self._get_transferred_images(
+                conn, [i for v in dest_dict.values() for i in v])
         for src_k in src_dict.keys():
             src_v = src_dict[src_k]
             if src_k in dest_dict.keys():
                 dest_v = dest_dict[src_k]
-                clean_dest = []
-                if not conn:
-                    clean_dest = dest_v
-                else:
-                    for i in dest_v:
-                        img_obj = conn.getObject("Image", i)
-                        anns = 0
-                        for j in img_obj.listAnnotations():
-                            ns = j.getNs()
-                            if ns.startswith(
-                                    "openmicroscopy.org/cli/transfer"):
-                                anns += 1
-                        if not anns:
-                            clean_dest.append(i)
+                clean_dest = [i for i in dest_v if i not in transferred]
                 if len(src_v) == len(clean_dest):
                     for count in range(len(src_v)):
                         map_key = f"Image:{src_v[count]}"
@@ -0,0 +1,72 @@
+# Copyright (C) 2022 The Jackson Laboratory
+# All rights reserved.
+#
+# Use is subject to license terms supplied in LICENSE.
+
+from omero.gateway import BlitzGateway
+from omero.sys import Parameters, Filter
+from omero.rtypes import rint, rlist, rlong
+from typing import Any, Dict, Iterator, List, Optional
+
+# ids bound to a single `IN (:ids)` parameter
+QUERY_BATCH_SIZE = 1000
+ROI_PAGE_SIZE = 500
+
+
+def batched(ids: List[int]) -> Iterator[List[int]]:
+    ids = list(ids)
+    for i in range(0, len(ids), QUERY_BATCH_SIZE):
+        yield ids[i:i + QUERY_BATCH_SIZE]
+
+
+def query_by_ids(conn: BlitzGateway, query: str, ids: List[int],
+                 projection: bool = False, ctx=None,
+                 params: Optional[Dict[str, Any]] = None) -> list:
+    """
+    Run `query` once per QUERY_BATCH_SIZE ids, bound to its `:ids`
+    parameter (with any other named `params`), and return all results:
+    objects, or raw rows if `projection` is set.
+    """
+    q = conn.getQueryService()
+    results = []
+    for batch in batched(ids):
+        p = Parameters()
+        p.map = dict(params or {}, ids=rlist([rlong(i) for i in batch]))
+        if projection:
+            results.extend(q.projection(query, p, ctx or conn.SERVICE_OPTS))
+        else:
+            results.extend(q.findAllByQuery(query, p,
+                                            ctx or conn.SERVICE_OPTS))
+    return results
+
+
+def roi_pages(conn: BlitzGateway, image_ids: List[int],
+              page_size: int = ROI_PAGE_SIZE, ctx=None) -> Iterator[list]:
+    """
+    Yield the ROIs (with their shapes) on the given images, one page of
+    `page_size` ROIs at a time. ROIs are paged by id, so only one page
+    needs to be held in memory.
+    """
+    q = conn.getQueryService()
+    for batch in batched(image_ids):
+        last_id = -1
+        while True:
+            params = Parameters()
+            params.map = {"ids": rlist([rlong(i) for i in batch]),
+                          "last": rlong(last_id)}
+            params.theFilter = Filter()
+            params.theFilter.limit = rint(page_size)
+            results = q.projection(
+                "SELECT r.id FROM Roi r WHERE r.image.id IN (:ids)"
+                " AND r.id > :last ORDER BY r.id",
+                params, ctx or conn.SERVICE_OPTS)
+            roi_ids = [r[0].val for r in results]
+            if not roi_ids:
+                break
+            last_id = roi_ids[-1]
+            yield query_by_ids(
+                conn,
+                "SELECT DISTINCT r FROM Roi r LEFT OUTER JOIN FETCH r.shapes"
+                " WHERE r.id IN (:ids) ORDER BY r.id", roi_ids, ctx=ctx)
+            if len(roi_ids) < page_size:
+                break
@@ -6,11 +6,33 @@
 #
 # Use is subject to license terms supplied in LICENSE.
 
-from ome_types import from_xml
+from ome_types import from_xml, to_xml
 from omero.cli import CLI
 from omero.gateway import BlitzGateway
+from omero.model import OriginalFileI, ChecksumAlgorithmI
+from omero.rtypes import rstring
 from omero_cli_transfer import TransferControl
+from generate_xml import OMEIndex, create_tag_and_ref, populate_checksums
+from generate_xml import create_metadata_xml, create_xml_and_ref
+from download_files import BlockReader, DownloadManifest, MANIFEST_NAME
+from download_files import FileDownloader
+from archive_files import ArchiveWriter, is_incompressible
+from archive_files import extract_archive, PackReader, remove_extracted
+from archive_files import verify_files
+from ome_index import ServerPathIndex
+from generate_omero_objects import create_roi_objects, parse_xml_metadata
+from generate_omero_objects import _ome_roi_key, _omero_roi_key
+from ome_types.model import ROI, Point, Polygon
+from pathlib import Path
+from zipfile import ZipFile, ZIP_STORED
 
+import archive_files
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import threading
 import pytest
 
 
@@ -53,6 +75,247 @@ class TestPackSide():
         assert set(self.transfer.metadata) == \
             set(["timestamp", "software", "version"])
 
+    def test_ome_index(self):
+        ome = OMEIndex()
+        tag, ref = create_tag_and_ref(id=1, value="tag")
+        assert ome.add_annotation(tag)
+        dup, _ = create_tag_and_ref(id=1, value="tag")
+        assert not ome.add_annotation(dup)
+        assert len(ome.ome.structured_annotations) == 1
+        assert ome.get_annotations([ref]) == [tag]
+        ome = OMEIndex(from_xml('test/data/transfer.xml'))
+        assert set(ome.images) == set(i.id for i in ome.ome.images)
+
+    def test_populate_checksums(self):
+        ome = from_xml('test/data/transfer.xml')
+        ns = 'openmicroscopy.org/cli/transfer'
+        md, ref = create_xml_and_ref(
+            id=1, namespace=ns,
+            value=create_metadata_xml({'origin_image_id': 1, 'md5': 'TBC'}))
+        ome.structured_annotations.append(md)
+        ome.images[0].annotation_refs.append(ref)
+        rec = {'path': 'a/b.tif', 'size': 3, 'sha1': 'x', 'md5': 'y'}
+        populate_checksums(ome, {ome.images[0].id: [rec]})
+        values = [to_xml(an.value) for an in ome.structured_annotations
+                  if an.namespace == ns]
+        assert any('<ns2:md5>y</ns2:md5>' in v for v in values)
+        assert any('Path="a/b.tif"' in v and 'SHA1="x"' in v
+                   for v in values)
+
+    def test_stream_readahead(self):
+        class FakeStore():
+            def __init__(self, data):
+                self.data = data
+                self.in_flight = 0
+                self.max_in_flight = 0
+
+            def begin_read(self, offset, length):
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                return self.data[offset:offset + length]
+
+            def end_read(self, result):
+                self.in_flight -= 1
+                return result
+
+        data = bytes(range(256)) * 40
+        store = FakeStore(data)
+        reader = BlockReader(store, len(data), block_size=1000, readahead=3)
+        handle = io.BytesIO()
+        shutil.copyfileobj(reader, handle, 1500)
+        assert handle.getvalue() == data
+        assert store.max_in_flight == 3
+        assert reader.checksums()["sha1"] == hashlib.sha1(data).hexdigest()
+        assert reader.checksums()["md5"] == hashlib.md5(data).hexdigest()
+
+    @pytest.mark.parametrize("zip", [True, False])
+    def test_archive_writer(self, tmp_path, zip):
+        folder = tmp_path / "pack_folder"
+        os.makedirs(folder / "figures")
+        (folder / "transfer.xml").write_text("<OME/>")
+        (folder / "figures" / "fig.json").write_text("{}")
+        path = str(tmp_path / ("pack.zip" if zip else "pack.tar"))
+        archive = ArchiveWriter(path, zip, str(folder))
+        archive.add(str(folder / "a" / "img.tif"), 3, io.BytesIO(b"abc"))
+        assert archive.contains(str(folder / "a" / "img.tif"))
+        archive.add_folder(str(folder))
+        archive.close()
+        out = tmp_path / "out"
+        shutil.unpack_archive(path, str(out))
+        assert (out / "a" / "img.tif").read_bytes() == b"abc"
+        assert (out / "figures" / "fig.json").read_text() == "{}"
+        if zip:
+            with ZipFile(path) as zf:
+                names = zf.namelist()
+        else:
+            with tarfile.open(path) as tf:
+                names = tf.getnames()
+        assert names[-1] == "transfer.xml"
+
+    @pytest.mark.parametrize("zip", [True, False])
+    def test_archive_writer_failed_member(self, tmp_path, zip):
+        class FailingReader:
+            def read(self, n=-1):
+                raise IOError("connection lost")
+
+        path = str(tmp_path / ("pack.zip" if zip else "pack.tar"))
+        archive = ArchiveWriter(path, zip, str(tmp_path))
+        with pytest.raises(RuntimeError):
+            archive.add(str(tmp_path / "bad.tif"), 10 * 1024 * 1024,
+                        FailingReader())
+        archive.add(str(tmp_path / "good.tif"), 3, io.BytesIO(b"abc"))
+        archive.close()
+        out = tmp_path / "out"
+        shutil.unpack_archive(path, str(out))
+        assert (out / "good.tif").read_bytes() == b"abc"
+
+    def test_failed_member_rejected(self, tmp_path):
+        class FailingStore():
+            def begin_read(self, offset, length):
+                return offset, length
+
+            def end_read(self, result):
+                offset, length = result
+                if offset >= 2 * 1024 * 1024:
+                    raise IOError("connection lost")
+                return b"\1" * length
+
+        folder = tmp_path / "pack_folder"
+        os.makedirs(folder)
+        path = str(tmp_path / "pack.tar")
+        archive = ArchiveWriter(path, False, str(folder))
+        downloader = FileDownloader(None, archive=archive)
+        target = str(folder / "img.bin")
+        with pytest.raises(RuntimeError):
+            downloader._write(FailingStore(), 10 * 1024 * 1024, target)
+        assert downloader.files[target]["failed"]
+        archive.close()
+        ome = from_xml('test/data/transfer.xml')
+        rec = dict(downloader.files[target], path="img.bin")
+        populate_checksums(ome, {ome.images[0].id: [rec]})
+        checksums = ServerPathIndex(ome.structured_annotations).checksums
+        assert checksums["img.bin"]["failed"] == "true"
+        out = str(tmp_path / "out")
+        extract_archive(path, out)
+        with pytest.raises(ValueError):
+            verify_files(out, checksums)
+        with pytest.raises(ValueError):
+            verify_files(out, checksums, [os.path.join(out, "img.bin")])
+
+    def test_checksum_mismatch_recorded(self, tmp_path):
+        class Store():
+            def begin_read(self, offset, length):
+                return b"abc"[offset:offset + length]
+
+            def end_read(self, result):
+                return result
+
+        folder = tmp_path / "pack_folder"
+        os.makedirs(folder)
+        path = str(tmp_path / "pack.tar")
+        archive = ArchiveWriter(path, False, str(folder))
+        downloader = FileDownloader(None, archive=archive)
+        target = str(folder / "img.bin")
+        checksums = downloader._write(Store(), 3, target)
+        ofile = OriginalFileI(1)
+        hasher = ChecksumAlgorithmI()
+        hasher.value = rstring("SHA1-160")
+        ofile.hasher = hasher
+        ofile.hash = rstring("0" * 40)
+        with pytest.raises(RuntimeError):
+            downloader._verify(ofile, target, checksums)
+        assert downloader.files[target] == {"size": 3, "sha1": "0" * 40,
+                                            "failed": True}
+        archive.close()
+        ome = from_xml('test/data/transfer.xml')
+        rec = dict(downloader.files[target], path="img.bin")
+        populate_checksums(ome, {ome.images[0].id: [rec]})
+        checksums = ServerPathIndex(ome.structured_annotations).checksums
+        out = str(tmp_path / "out")
+        extract_archive(path, out)
+        with pytest.raises(ValueError):
+            verify_files(out, checksums)
+
+    def test_run_downloads_ignore_errors(self, tmp_path):
+        class Downloader:
+            manifest = None
+
+            def download_annotation(self, ann_id, target):
+                raise RuntimeError("Checksum mismatch")
+
+        downloads = [('annotation', 1, str(tmp_path / "a.txt"))]
+        self.transfer._run_downloads(downloads, str(tmp_path), True,
+                                     Downloader(), 2)
+        with pytest.raises(RuntimeError):
+            self.transfer._run_downloads(downloads, str(tmp_path), False,
+                                         Downloader(), 2)
+
+    def test_compressed_archive(self, tmp_path):
+        assert is_incompressible(os.urandom(4096))
+        assert not is_incompressible(b"transfer" * 512)
+        folder = tmp_path / "pack_folder"
+        os.makedirs(folder)
+        (folder / "transfer.xml").write_text("<OME/>")
+        data = os.urandom(2 * 1024 * 1024) + b"\0" * 6 * 1024 * 1024
+        path = str(tmp_path / "pack.tar.gz")
+        archive = ArchiveWriter(path, False, str(folder), "tar.gz",
+                                threads=2)
+        archive.add(str(folder / "img.bin"), len(data), io.BytesIO(data))
+        archive.add_folder(str(folder))
+        archive.close()
+        with tarfile.open(path, "r:gz") as tf:
+            assert tf.getnames() == ["img.bin", "transfer.xml"]
+            assert tf.extractfile("img.bin").read() == data
+
+    def test_download_manifest(self, tmp_path):
+        folder = str(tmp_path)
+        opts = {"objects": ["Project:1"]}
+        manifest = DownloadManifest(folder, opts)
+        assert manifest.id_list is None
+        manifest.save_metadata("<OME/>", {"Image:1": "a/b.tif"})
+        target = str(tmp_path / "b.tif")
+        with open(target, "wb") as fp:
+            fp.write(b"1234")
+        sha1 = hashlib.sha1(b"1234").hexdigest()
+        manifest.add(target, {"size": 4, "sha1": sha1, "md5": "y"})
+        with open(manifest.path, "a") as fp:
+            fp.write('{"path": "trunc')
+        resumed = DownloadManifest(folder, opts)
+        assert resumed.id_list == {"Image:1": "a/b.tif"}
+        assert resumed.get(target)["sha1"] == sha1
+        assert resumed.get(str(tmp_path / "c.tif")) is None
+        with open(target, "wb") as fp:
+            fp.write(b"1235")
+        assert resumed.get(target) is None
+        with pytest.raises(ValueError):
+            DownloadManifest(folder, {"objects": ["Project:2"]})
+        resumed.remove()
+        assert DownloadManifest(folder, opts).id_list is None
+
+    def test_manifest_truncated_line(self, tmp_path):
+        folder = str(tmp_path)
+        opts = {"objects": ["Project:1"]}
+        DownloadManifest(folder, opts).save_metadata("<OME/>", {})
+        with open(str(tmp_path / MANIFEST_NAME), "a") as fp:
+            fp.write('{"path": "trunc')
+        manifest = DownloadManifest(folder, opts)
+        for name in ("a.tif", "b.tif"):
+            (tmp_path / name).write_bytes(b"1234")
+            manifest.add(str(tmp_path / name), {"size": 4, "sha1": "x"})
+        resumed = DownloadManifest(folder, opts)
+        assert set(resumed.files) == {"a.tif", "b.tif"}
+
+    def test_manifest_metadata_order(self, tmp_path):
+        fields = ["md5", "img_id", "db_id", "orig_user", "hostname"]
+        self.transfer._process_metadata(list(fields))
+        manifest = DownloadManifest(str(tmp_path),
+                                    {"metadata": self.transfer.metadata})
+        manifest.save_metadata("<OME/>", {})
+        self.transfer._process_metadata(list(reversed(fields)))
+        resumed = DownloadManifest(str(tmp_path),
+                                   {"metadata": self.transfer.metadata})
+        assert resumed.id_list == {}
+
 
 class TestUnpackSide():
     def setup_method(self):
@@ -82,11 +345,158 @@ class TestUnpackSide():
         assert str(folder.resolve()) == \
             "/omero-cli-transfer/test/data/valid_single_image"
 
+    @pytest.mark.parametrize("pack", ["test/data/valid_single_image.zip",
+                                      "test/data/valid_single_image.tar"])
+    def test_extract_archive(self, tmp_path, pack):
+        with open(pack, "rb") as fp:
+            md5 = hashlib.md5(fp.read()).hexdigest()
+        assert extract_archive(pack, str(tmp_path / "out"), 2) == md5
+        shutil.unpack_archive(pack, str(tmp_path / "ref"))
+        for path, _, files in os.walk(tmp_path / "ref"):
+            for f in files:
+                ref = Path(path) / f
+                out = tmp_path / "out" / ref.relative_to(tmp_path / "ref")
+                assert out.read_bytes() == ref.read_bytes()
+
+    def test_extract_archive_unwritable(self, tmp_path, monkeypatch):
+        # the member is streamed in many chunks; a worker that cannot
+        # write it must not leave the reading thread blocked
+        monkeypatch.setattr(archive_files, "MEMBER_BUFFER_SIZE", 1024)
+        monkeypatch.setattr(archive_files, "READ_SIZE", 1024)
+        path = str(tmp_path / "pack.zip")
+        with ZipFile(path, "w", ZIP_STORED) as zf:
+            zf.writestr("a/img.bin", os.urandom(64 * 1024))
+            zf.writestr("transfer.xml", "<OME/>")
+        os.makedirs(tmp_path / "out" / "a" / "img.bin")
+        with pytest.raises(IsADirectoryError):
+            extract_archive(path, str(tmp_path / "out"), 2)
+
+    def test_extract_archive_read_error(self, tmp_path, monkeypatch):
+        # a read error while a member is streamed must reach the caller
+        monkeypatch.setattr(archive_files, "MEMBER_BUFFER_SIZE", 1024)
+        monkeypatch.setattr(archive_files, "READ_SIZE", 1024)
+        read = archive_files._HashingReader.read
+
+        def failing_read(self, n=-1):
+            if self.position > 16 * 1024:
+                raise OSError("read error")
+            return read(self, n)
+
+        monkeypatch.setattr(archive_files._HashingReader, "read",
+                            failing_read)
+        path = str(tmp_path / "pack.zip")
+        with ZipFile(path, "w", ZIP_STORED) as zf:
+            zf.writestr("a/img.bin", os.urandom(64 * 1024))
+        with pytest.raises(OSError):
+            extract_archive(path, str(tmp_path / "out"), 2)
+
+    def test_extract_compressed_archive(self, tmp_path):
+        # larger than one compressed chunk, so written as several members
+        folder = tmp_path / "pack_folder"
+        os.makedirs(folder)
+        (folder / "transfer.xml").write_text("<OME/>")
+        data = os.urandom(2 * 1024 * 1024) + b"\0" * 6 * 1024 * 1024
+        path = str(tmp_path / "pack.tar.gz")
+        archive = ArchiveWriter(path, False, str(folder), "tar.gz",
+                                threads=2)
+        archive.add(str(folder / "img.bin"), len(data), io.BytesIO(data))
+        archive.add_folder(str(folder))
+        archive.close()
+        with open(path, "rb") as fp:
+            md5 = hashlib.md5(fp.read()).hexdigest()
+        assert extract_archive(path, str(tmp_path / "out")) == md5
+        assert (tmp_path / "out" / "img.bin").read_bytes() == data
+        assert (tmp_path / "out" / "transfer.xml").read_text() == "<OME/>"
+
+    @pytest.mark.parametrize("pack", ["test/data/valid_single_image.zip",
+                                      "test/data/valid_single_image.tar"])
+    def test_pack_reader(self, tmp_path, pack):
+        img = "root_0/2023-12/18/14-52-03.548/combined_result.tiff"
+        reader = PackReader(pack)
+        reader.extract_except([img], str(tmp_path))
+        assert (tmp_path / "transfer.xml").exists()
+        assert not (tmp_path / img).exists()
+        paths = reader.extract("root_0/2023-12/", str(tmp_path))
+        assert paths == [str(tmp_path / img)]
+        remove_extracted(paths, str(tmp_path))
+        assert os.listdir(tmp_path) == ["transfer.xml"]
+        with open(pack, "rb") as fp:
+            assert reader.md5() == hashlib.md5(fp.read()).hexdigest()
+        stop = threading.Event()
+        stop.set()
+        assert reader.md5(stop) is None
+        reader.close()
+
     def test_non_existing_file(self):
         with pytest.raises(FileNotFoundError):
             self.transfer._load_from_pack('data/fake_file.zip',
                                           'data/output_folder')
 
+    def test_get_image_ids(self):
+        output = ("---\n"
+                  "- Fileset: 12\n"
+                  "  Image: [103, 101]\n"
+                  "- Fileset: 13\n"
+                  "  Plate: [4]\n"
+                  "  Image: 102\n")
+        assert self.transfer._get_image_ids(output) == [101, 102, 103]
+        assert self.transfer._get_image_ids("") == []
+
+    def test_server_path_index(self):
+        ome = from_xml('test/data/transfer.xml')
+        paths = ServerPathIndex(ome.structured_annotations)
+        for img in ome.images:
+            assert paths.get_server_path(img) == \
+                "root_0/2022-01/14/18-30-55.264/combined_result.tiff"
+        assert paths.metadata == {}
+
+    def test_create_roi_objects(self):
+        roi = ROI(name="cell", union=[
+            Point(x=1, y=2, stroke_color=0x12345678),
+            Polygon(points="1,2 3,4, 5,6,")])
+        roi_objs = create_roi_objects([(7, roi), (8, roi)])
+        assert len(roi_objs) == 2
+        assert roi_objs[1].getImage().getId().getValue() == 8
+        assert roi_objs[0].getName().getValue() == "cell"
+        shapes = {type(sh).__name__: sh for sh in roi_objs[0].copyShapes()}
+        assert shapes["PointI"].getStrokeColor().getValue() == 0x12345678
+        assert shapes["PolygonI"].getFillColor().getValue() == 0
+        assert shapes["PolygonI"].getPoints().getValue() == \
+            "1.0,2.0 3.0,4.0 5.0,6.0"
+        # created ROIs match their source, style included
+        assert _omero_roi_key(roi_objs[0]) == _ome_roi_key(roi)
+        restyled = ROI(name="cell", union=[
+            Point(x=1, y=2, stroke_color=0x12345679),
+            Polygon(points="1,2 3,4, 5,6,")])
+        assert _omero_roi_key(roi_objs[0]) != _ome_roi_key(restyled)
+
+    def test_verify_files(self, tmp_path):
+        ome = from_xml('test/data/transfer.xml')
+        data = b"abc"
+        rec = {'path': 'a/b.tif', 'size': 3,
+               'sha1': hashlib.sha1(data).hexdigest(),
+               'md5': hashlib.md5(data).hexdigest()}
+        populate_checksums(ome, {ome.images[0].id: [rec]})
+        paths = ServerPathIndex(ome.structured_annotations)
+        assert paths.checksums == {'a/b.tif': {
+            'size': '3', 'sha1': rec['sha1'], 'md5': rec['md5']}}
+        with pytest.raises(ValueError):
+            verify_files(str(tmp_path), paths.checksums)
+        os.makedirs(tmp_path / "a")
+        (tmp_path / "a" / "b.tif").write_bytes(data)
+        verify_files(str(tmp_path), paths.checksums)
+        verify_files(str(tmp_path), paths.checksums, [])
+        (tmp_path / "a" / "b.tif").write_bytes(b"abd")
+        with pytest.raises(ValueError):
+            verify_files(str(tmp_path), paths.checksums,
+                         [str(tmp_path / "a" / "b.tif")])
+
+    def test_parse_xml_metadata_md5(self):
+        kv = parse_xml_metadata({'md5': 'y'}, ['md5'], 'packhash')
+        assert kv == [['md5', 'y']]
+        kv = parse_xml_metadata({'md5': 'TBC'}, ['md5'], 'packhash')
+        assert kv == [['md5', 'packhash']]
+
     def test_src_img_map(self):
         ome = from_xml('test/data/transfer.xml')
         _, src_img_map, filelist = self.transfer._create_image_map(ome)